@@ -0,0 +1,51 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Run one of the tools against a fake Flickr server (see
+# fake_flickr.py) rather than the real one:
+#
+#   python benchmarks/bootstrap.py URL SCRIPT [ARGUMENTS...]
+#
+# This points flickrapi at URL, gives it a token so that it doesn't
+# try to open a browser, and turns off the API rate limit.  It's used
+# by run.py, with HOME set to a temporary directory.
+
+import os
+import runpy
+import sys
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+
+url, script = sys.argv[1:3]
+sys.argv = [script] + sys.argv[3:]
+
+import flickrapi
+from flickrapi.auth import FlickrAccessToken
+from flickrapi.tokencache import OAuthTokenCache
+from fake_flickr import NSID, USERNAME
+
+flickrapi.FlickrAPI.REST_URL = url + '/services/rest/'
+flickrapi.FlickrAPI.UPLOAD_URL = url + '/services/upload/'
+OAuthTokenCache(os.environ['BENCHMARK_API_KEY']).token = FlickrAccessToken(
+    'token', 'secret', 'write', 'Benchmark', USERNAME, NSID)
+
+import flickr_checksum_tags
+flickr_checksum_tags.throttler.rate = flickr_checksum_tags.throttler.BURST = 1e9
+
+if script == 'flickr_checksum_tags.py':
+    # Run it as the module we've just set up, rather than a fresh
+    # copy as __main__, so that the throttler change applies.
+    flickr_checksum_tags.main()
+else:
+    runpy.run_path(os.path.join(repository, script), run_name='__main__')
@@ -0,0 +1,322 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A local stand-in for the parts of the Flickr API (and the farm
+# servers) that the tools in this repository use, so that they can be
+# benchmarked without a real account.  It serves:
+#
+#   /services/rest/     the REST methods in FakeFlickr.methods
+#   /services/upload/   photo uploads
+#   /farm/<ID>_o.jpg    the "original" of each photo
+#
+# The library is generated from a seed, so every run with the same
+# settings sees the same photos.  Every request is counted, can be
+# delayed by 'latency' seconds and fails with HTTP 500 with
+# probability 'error_rate'.
+
+import hashlib
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+from xml.sax.saxutils import escape, quoteattr
+
+md5_machine_tag_prefix = "checksum:md5="
+sha1_machine_tag_prefix = "checksum:sha1="
+
+NSID = '12345678@N00'
+USERNAME = 'bench'
+
+
+class FakeFlickr:
+    def __init__(self, n_photos=1000, photo_size=100000, tagged_fraction=0.5,
+                 latency=0.0, error_rate=0.0, seed=0):
+        self.photo_size = photo_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.library_lock = threading.Lock()
+        self.stats = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.next_id = 1000000
+        self.photos = {}
+        now = int(time.time())
+        for i in range(n_photos):
+            photo = self.add_photo(i, "Photo {0}".format(i), now - n_photos + i)
+            if self.random.random() < tagged_fraction:
+                photo['tags'].update(self.checksum_tags(photo['content_id']))
+
+    # The bytes of a photo are generated from its 'content_id', rather
+    # than kept in memory:
+    def content(self, content_id):
+        block = hashlib.sha256("{0} {1}".format(self.seed, content_id).encode()).digest()
+        return (block * (self.photo_size // len(block) + 1))[:self.photo_size]
+
+    def checksum_tags(self, content_id):
+        content = self.content(content_id)
+        return set([md5_machine_tag_prefix + hashlib.md5(content).hexdigest(),
+                    sha1_machine_tag_prefix + hashlib.sha1(content).hexdigest()])
+
+    def add_photo(self, content, title, date_uploaded, tags=()):
+        self.next_id += 1
+        photo = dict(id=str(self.next_id), title=title, tags=set(tags),
+                     dateupload=date_uploaded, lastupdate=date_uploaded,
+                     secret='%010x' % self.next_id)
+        # Generated photos are made from their index when needed,
+        # uploaded ones are kept as they are:
+        if isinstance(content, int):
+            photo['content_id'] = content
+        else:
+            photo['data'] = content
+        self.photos[photo['id']] = photo
+        return photo
+
+    def photo_data(self, photo):
+        if 'data' in photo:
+            return photo['data']
+        return self.content(photo['content_id'])
+
+    def serve(self, port=0):
+        server = ThreadingHTTPServer(('127.0.0.1', port), handler_for(self))
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+        return server
+
+    def count(self, name, n_bytes_sent=0, n_bytes_received=0):
+        with self.lock:
+            self.stats[name] += 1
+            self.bytes_sent += n_bytes_sent
+            self.bytes_received += n_bytes_received
+
+    # ---- Responses ----
+
+    def photo_xml(self, photo, extras, tag='photo'):
+        attrib = dict(id=photo['id'], owner=NSID, secret=photo['secret'], server='1', farm='1',
+                      title=photo['title'], ispublic='1', isfriend='0', isfamily='0')
+        extras = set(e.strip() for e in extras.split(',') if e.strip())
+        farm_url = '{0}/farm/{1}_o.jpg'.format(self.url, photo['id'])
+        if 'machine_tags' in extras:
+            attrib['machine_tags'] = ' '.join(sorted(photo['tags']))
+        if 'last_update' in extras:
+            attrib['lastupdate'] = str(photo['lastupdate'])
+        if 'date_upload' in extras:
+            attrib['dateupload'] = str(photo['dateupload'])
+        if 'original_format' in extras:
+            attrib['originalformat'] = 'jpg'
+            attrib['originalsecret'] = photo['secret']
+        for size in ('o', 'b', 's', 't', 'm'):
+            if 'url_' + size in extras:
+                attrib['url_' + size] = farm_url
+        return '<{0} {1} />'.format(tag, ' '.join('{0}={1}'.format(k, quoteattr(v))
+                                                  for k, v in sorted(attrib.items())))
+
+    def photos_xml(self, photos, params, tag='photos'):
+        per_page = int(params.get('per_page', 100))
+        page = int(params.get('page', 1))
+        start = (page - 1) * per_page
+        selected = photos[start:start + per_page]
+        extras = params.get('extras', '')
+        pages = (len(photos) + per_page - 1) // per_page
+        return '<{0} page="{1}" pages="{2}" perpage="{3}" total="{4}">{5}</{0}>'.format(
+            tag, page, pages, per_page, len(photos),
+            ''.join(self.photo_xml(p, extras) for p in selected))
+
+    def sorted_photos(self, params):
+        photos = list(self.photos.values())
+        if params.get('sort', '').endswith('-asc'):
+            photos.sort(key=lambda p: (p['dateupload'], p['id']))
+        else:
+            photos.sort(key=lambda p: (p['dateupload'], p['id']), reverse=True)
+        return photos
+
+    def photos_search(self, params):
+        photos = self.sorted_photos(params)
+        if params.get('tags'):
+            tags = set(t.strip() for t in params['tags'].split(',') if t.strip())
+            if params.get('tag_mode') == 'all':
+                photos = [p for p in photos if tags <= p['tags']]
+            else:
+                photos = [p for p in photos if tags & p['tags']]
+        if params.get('min_upload_date'):
+            photos = [p for p in photos if p['dateupload'] >= int(params['min_upload_date'])]
+        return self.photos_xml(photos, params)
+
+    def photos_recentlyUpdated(self, params):
+        photos = [p for p in self.sorted_photos(params) if p['lastupdate'] >= int(params['min_date'])]
+        return self.photos_xml(photos, params)
+
+    def favorites_getPublicList(self, params):
+        return self.photos_xml(self.sorted_photos(params), params)
+
+    def photos_addTags(self, params):
+        photo = self.photos[params['photo_id']]
+        photo['tags'].update(params['tags'].split())
+        photo['lastupdate'] = int(time.time())
+        return ''
+
+    def photos_setDates(self, params):
+        if params['photo_id'] not in self.photos:
+            raise KeyError(params['photo_id'])
+        return ''
+
+    def photos_getInfo(self, params):
+        photo = self.photos[params['photo_id']]
+        tags = ''.join('<tag raw={0} machine_tag="1">{1}</tag>'.format(quoteattr(t), escape(t))
+                       for t in sorted(photo['tags']))
+        return ('<photo id="{0}" secret="{1}" server="1" farm="1" originalsecret="{1}" '
+                'originalformat="jpg"><owner nsid="{2}" username="{3}" />'
+                '<title>{4}</title><tags>{5}</tags></photo>').format(
+                    photo['id'], photo['secret'], NSID, USERNAME, escape(photo['title']), tags)
+
+    def people_findByUsername(self, params):
+        return '<user id="{0}" nsid="{0}"><username>{1}</username></user>'.format(NSID, USERNAME)
+
+    def people_getInfo(self, params):
+        return ('<person id="{0}" nsid="{0}"><username>{1}</username>'
+                '<photosurl>{2}/photos/{1}/</photosurl></person>').format(NSID, USERNAME, self.url)
+
+    def urls_lookupUser(self, params):
+        return '<user id="{0}"><username>{1}</username></user>'.format(NSID, USERNAME)
+
+    def test_login(self, params):
+        return '<user id="{0}"><username>{1}</username></user>'.format(NSID, USERNAME)
+
+    def auth_oauth_checkToken(self, params):
+        return ('<oauth><token>token</token><perms>write</perms>'
+                '<user nsid="{0}" username="{1}" fullname="Benchmark" /></oauth>').format(NSID, USERNAME)
+
+    methods = dict(('flickr.' + name.replace('_', '.'), name) for name in [
+        'photos_search', 'photos_recentlyUpdated', 'photos_addTags', 'photos_setDates',
+        'photos_getInfo', 'favorites_getPublicList', 'people_findByUsername',
+        'people_getInfo', 'urls_lookupUser', 'test_login', 'auth_oauth_checkToken'])
+
+    def rest(self, params):
+        method = params.get('method', '')
+        if method not in self.methods:
+            return '<rsp stat="fail"><err code="112" msg="Method not found" /></rsp>'
+        try:
+            body = getattr(self, self.methods[method])(params)
+        except KeyError:
+            return '<rsp stat="fail"><err code="1" msg="Not found" /></rsp>'
+        return '<rsp stat="ok">{0}</rsp>'.format(body)
+
+    def upload(self, fields):
+        tags = fields.get('tags', b'').decode().split()
+        photo = self.add_photo(fields['photo'], fields.get('title', b'').decode(),
+                               int(time.time()), tags)
+        return '<rsp stat="ok"><photoid>{0}</photoid></rsp>'.format(photo['id'])
+
+
+def parse_multipart(content_type, body):
+    from email.parser import BytesParser
+    from email.policy import HTTP
+
+    message = BytesParser(policy=HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        fields[name] = part.get_payload(decode=True)
+    return fields
+
+
+def handler_for(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, body, content_type='text/xml; charset=utf-8', head=False):
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+            return len(body)
+
+        def read_body(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return self.rfile.read(length)
+
+        def fail_randomly(self, name):
+            if fake.latency:
+                time.sleep(fake.latency)
+            if fake.error_rate and fake.random.random() < fake.error_rate:
+                fake.count('error ' + name)
+                self.reply(500, 'Internal Server Error', 'text/plain')
+                return True
+            return False
+
+        def farm(self, head=False):
+            photo_id = self.path.rsplit('/', 1)[-1].split('_')[0]
+            if self.fail_randomly('farm'):
+                return
+            photo = fake.photos.get(photo_id)
+            if photo is None:
+                self.reply(404, 'Not Found', 'text/plain')
+                return
+            n_bytes = self.reply(200, fake.photo_data(photo), 'image/jpeg', head=head)
+            fake.count('farm', n_bytes_sent=0 if head else n_bytes)
+
+        def do_HEAD(self):
+            if self.path.startswith('/farm/'):
+                self.farm(head=True)
+            else:
+                self.reply(404, 'Not Found', 'text/plain', head=True)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path.startswith('/farm/'):
+                self.farm()
+            elif url.path == '/services/rest/':
+                self.rest(dict(parse_qsl(url.query)), 0)
+            else:
+                self.reply(404, 'Not Found', 'text/plain')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self.read_body()
+            if url.path == '/services/rest/':
+                self.rest(dict(parse_qsl(body.decode('utf-8'))), len(body))
+            elif url.path == '/services/upload/':
+                if self.fail_randomly('upload'):
+                    return
+                fields = parse_multipart(self.headers['Content-Type'], body)
+                fake.count('upload', n_bytes_received=len(body))
+                with fake.library_lock:
+                    body = fake.upload(fields)
+                self.reply(200, body)
+            else:
+                self.reply(404, 'Not Found', 'text/plain')
+
+        def rest(self, params, n_bytes_received):
+            method = params.get('method', '')
+            if self.fail_randomly(method):
+                return
+            fake.count(method, n_bytes_received=n_bytes_received)
+            with fake.library_lock:
+                body = fake.rest(params)
+            self.reply(200, body)
+
+    return Handler
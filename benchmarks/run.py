@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark the tools against a local fake Flickr server, e.g.:
+#
+#   python benchmarks/run.py --photos 1000 --latency 0.05 --json results.jsonl
+#
+# Each tool is run in a fresh process, with a fresh library and a
+# temporary HOME (so the real ~/.flickr-api and database are never
+# touched), and the report gives photos/s, bytes/s, API calls per
+# photo and peak RSS.  With --json, one line per run is appended to a
+# file, so that results can be compared between releases.
+#
+# The tools need flickrapi (with lxml) and urllib3 to be installed.
+
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from fake_flickr import FakeFlickr, USERNAME
+
+here = os.path.dirname(os.path.abspath(__file__))
+repository = os.path.dirname(here)
+
+API_KEY = 'benchmark'
+
+tools = ('add_checksum', 'sync', 'find_not_uploaded', 'upload', 'favourites')
+
+
+def write_files(directory, fake, content_ids):
+    os.makedirs(directory)
+    for content_id in content_ids:
+        with open(os.path.join(directory, 'photo-{0}.jpg'.format(content_id)), 'wb') as f:
+            f.write(fake.content(content_id))
+
+
+# Return the command line, working directory and number of photos
+# handled for a run of 'tool' in the directory 'work':
+def prepare(tool, fake, work, n_photos):
+    if tool == 'add_checksum':
+        return ['flickr_checksum_tags.py', '-a', USERNAME], work, n_photos
+    elif tool == 'sync':
+        return ['flickr_checksum_tags.py', '--sync', USERNAME], work, n_photos
+    elif tool == 'find_not_uploaded':
+        # Half of the files are in the library, half are new:
+        photos = os.path.join(work, 'photos')
+        write_files(photos, fake, range(n_photos // 2, n_photos + n_photos // 2))
+        return ['find_not_uploaded.py', photos], work, n_photos
+    elif tool == 'upload':
+        photos = os.path.join(work, 'photos')
+        write_files(photos, fake, range(n_photos, 2 * n_photos))
+        return ['flickr-upload.py', photos], work, n_photos
+    elif tool == 'favourites':
+        downloads = os.path.join(work, 'downloads')
+        os.makedirs(downloads)
+        return ['download-flickr-favourites.py', USERNAME], downloads, n_photos
+
+
+def run(tool, options, extra_arguments):
+    fake = FakeFlickr(n_photos=options.photos, photo_size=options.photo_size,
+                      tagged_fraction=options.tagged_fraction, latency=options.latency,
+                      error_rate=options.error_rate, seed=options.seed)
+    server = fake.serve()
+    try:
+        with tempfile.TemporaryDirectory(prefix='flickr-benchmark-') as work:
+            with open(os.path.join(work, '.flickr-api'), 'w') as f:
+                f.write("api_key = {0}\napi_secret = {0}\n".format(API_KEY))
+            command, cwd, n_photos = prepare(tool, fake, work, options.photos)
+            command = ([sys.executable, os.path.join(here, 'bootstrap.py'), fake.url]
+                       + command + extra_arguments)
+            environment = dict(os.environ, HOME=work, BENCHMARK_API_KEY=API_KEY,
+                               PYTHONPATH=os.pathsep.join([here, repository,
+                                                           os.environ.get('PYTHONPATH', '')]))
+            log_filename = os.path.join(work, 'output.log')
+            with open(log_filename, 'w') as log:
+                start = time.time()
+                process = subprocess.Popen(command, cwd=cwd, env=environment,
+                                           stdout=log, stderr=subprocess.STDOUT)
+                _, status, rusage = os.wait4(process.pid, 0)
+                seconds = time.time() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if process.returncode != 0:
+                with open(log_filename) as log:
+                    output = log.read()
+                print("{0} failed with exit status {1}:\n{2}".format(
+                    tool, process.returncode, output[-2000:]))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    api_calls = dict((name, n) for name, n in fake.stats.items()
+                     if name.startswith('flickr.') and name != 'flickr.auth.oauth.checkToken')
+    n_bytes = fake.bytes_sent + fake.bytes_received
+    return dict(tool=tool,
+                arguments=extra_arguments,
+                exit_status=process.returncode,
+                seconds=round(seconds, 3),
+                photos=n_photos,
+                photos_per_second=round(n_photos / seconds, 2),
+                bytes=n_bytes,
+                bytes_per_second=round(n_bytes / seconds),
+                api_calls=sum(api_calls.values()),
+                api_calls_per_photo=round(float(sum(api_calls.values())) / n_photos, 3),
+                api_calls_by_method=api_calls,
+                http_errors=sum(n for name, n in fake.stats.items() if name.startswith('error ')),
+                # ru_maxrss is in kilobytes on Linux:
+                peak_rss_bytes=rusage.ru_maxrss * 1024)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=repository, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('tools', nargs='*', metavar='TOOL', default=list(tools),
+                        help='the tools to benchmark: ' + ', '.join(tools) + ' (default: all)')
+    parser.add_argument('--photos', type=int, default=200,
+                        help='number of photos in the library (default: 200)')
+    parser.add_argument('--photo-size', dest='photo_size', type=int, default=200000,
+                        metavar='BYTES', help='size of each photo (default: 200000)')
+    parser.add_argument('--tagged-fraction', dest='tagged_fraction', type=float, default=0.5,
+                        help='fraction of the library that already has checksum tags (default: 0.5)')
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                        help='delay added to every request to the fake server')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0,
+                        help='fraction of requests that fail with HTTP 500')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--args', dest='extra', action='append', default=[],
+                        metavar='TOOL=ARGUMENTS',
+                        help='extra arguments for a tool, e.g. "find_not_uploaded=--jobs 4"')
+    parser.add_argument('--json', dest='json', metavar='FILENAME',
+                        help='append the results to FILENAME, one JSON object per line')
+    options = parser.parse_args()
+
+    extra_arguments = {}
+    for extra in options.extra:
+        tool, arguments = extra.split('=', 1)
+        extra_arguments[tool] = shlex.split(arguments)
+
+    for tool in options.tools:
+        if tool not in tools:
+            parser.error("Unknown tool '{0}'".format(tool))
+
+    print("{0:<18} {1:>8} {2:>10} {3:>12} {4:>10} {5:>10}".format(
+        'tool', 'seconds', 'photos/s', 'bytes/s', 'calls/photo', 'peak RSS'))
+    for tool in options.tools:
+        result = run(tool, options, extra_arguments.get(tool, []))
+        print("{0:<18} {1:>8.2f} {2:>10.1f} {3:>12} {4:>10.2f} {5:>9}M{6}".format(
+            tool, result['seconds'], result['photos_per_second'], result['bytes_per_second'],
+            result['api_calls_per_photo'], result['peak_rss_bytes'] // (1024 * 1024),
+            '' if result['exit_status'] == 0 else '  (FAILED)'))
+        if options.json:
+            result.update(revision=git_revision(), time=int(time.time()),
+                          settings=dict(photos=options.photos, photo_size=options.photo_size,
+                                        tagged_fraction=options.tagged_fraction,
+                                        latency=options.latency, error_rate=options.error_rate,
+                                        seed=options.seed))
+            with open(options.json, 'a') as f:
+                f.write(json.dumps(result, sort_keys=True) + "\n")
+
+
+if __name__ == '__main__':
+    main()
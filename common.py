@@ -17,36 +17,172 @@ import sys
 import os
 import re
 from subprocess import Popen, PIPE
+from metrics import metrics
+from retry import HTTPStatusError
 
 flickr_api_filename = os.path.join(os.environ['HOME'],'.flickr-api')
-if not os.path.exists(flickr_api_filename):
-    print("You must put your Flickr API key and secret in "+flickr_api_filename)
 
-configuration = {}
-for line in open(flickr_api_filename):
-    if len(line.strip()) == 0:
+# The API key and secret are only read when they are first needed, so
+# that commands which don't talk to Flickr work without them.
+configuration = None
+
+def get_configuration():
+    global configuration
+    if configuration is not None:
+        return configuration
+
+    if not os.path.exists(flickr_api_filename):
+        print("You must put your Flickr API key and secret in "+flickr_api_filename)
+        sys.exit(1)
+
+    result = {}
+    for line in open(flickr_api_filename):
+        if len(line.strip()) == 0:
+            continue
+        m = re.search(r'\s*(\S+)\s*=\s*(\S+)\s*$',line)
+        if m:
+            result[m.group(1)] = m.group(2)
+        if not m:
+            print("Each line of "+flickr_api_filename+" must be either empty")
+            print("or of the form 'key = value'")
+            sys.exit(1)
         continue
-    m = re.search('\s*(\S+)\s*=\s*(\S+)\s*$',line)
-    if m:
-        configuration[m.group(1)] = m.group(2)
-    if not m:
-        print("Each line of "+flickr_api_filename+" must be either empty")
-        print("or of the form 'key = value'")
+
+    if not ('api_key' in result and 'api_secret' in result):
+        print("Both api_key and api_secret must be defined in "+flickr_api_filename)
         sys.exit(1)
-    continue
 
-if not ('api_key' in configuration and 'api_secret' in configuration):
-    print("Both api_key and api_secret must be defined in "+flickr_api_filename)
+    configuration = result
+    return configuration
 
-def md5sum(filename):
+# The digests we calculate for every file, and the size of the blocks
+# we read files in.  Reading in fixed size blocks keeps the memory use
+# bounded even for multi-GB videos.
+checksum_algorithms = ('md5', 'sha1')
+checksum_chunk_size = 1024 * 1024
+
+# How much of the start and of the end of a file the partial checksum
+# covers:
+partial_checksum_span = 64 * 1024
+
+# The md5 of the first and last 'span' bytes of a file (of the whole
+# file, if it's no more than twice that).  Together with the size it
+# tells most files apart without reading them in full.  It has the
+# update()/hexdigest() interface of hashlib, so that it can be worked
+# out on the way past when a file is read or downloaded in full.
+class PartialChecksum:
+    def __init__(self, span=partial_checksum_span):
+        self.span = span
+        self.head = b''
+        self.tail = b''
+        self.size = 0
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        if len(self.head) < self.span:
+            n = self.span - len(self.head)
+            self.head += chunk[:n]
+            chunk = chunk[n:]
+        if len(chunk) >= self.span:
+            self.tail = bytes(chunk[-self.span:])
+        elif chunk:
+            self.tail = (self.tail + chunk)[-self.span:]
+
+    def hexdigest(self):
+        import hashlib
+        return hashlib.md5(self.head + self.tail).hexdigest()
+
+# Calculate all the digests in 'algorithms' in a single pass over an
+# iterable of byte strings.  Returns a dictionary mapping algorithm
+# name to hex digest, e.g. {'md5': '...', 'sha1': '...'}.  The
+# algorithm 'partial' is a PartialChecksum, and also adds the 'size'.
+def chunks_checksums(chunks, algorithms=checksum_algorithms):
     import hashlib
+    hashes = [(name, PartialChecksum() if name == 'partial' else hashlib.new(name))
+              for name in algorithms]
+    for chunk in chunks:
+        for name, h in hashes:
+            h.update(chunk)
+    checksums = dict((name, h.hexdigest()) for name, h in hashes)
+    if 'partial' in checksums:
+        checksums['size'] = dict(hashes)['partial'].size
+    return checksums
+
+def file_chunks(filename, chunk_size=checksum_chunk_size):
     with open(filename, 'rb') as f:
-        return hashlib.md5(f.read()).hexdigest()
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
 
-def sha1sum(filename):
-    import hashlib
+# Add the size of each chunk to the counter 'name' as it goes past:
+def counted(chunks, name):
+    for chunk in chunks:
+        metrics.count(name, len(chunk))
+        yield chunk
+
+# Calculate all the digests of a file, reading it only once:
+def file_checksums(filename, algorithms=checksum_algorithms):
+    with metrics.timer('hash'):
+        return chunks_checksums(counted(file_chunks(filename), 'hash_bytes'), algorithms)
+
+# The PartialChecksum of a file, which only reads the start and end:
+def partial_checksum(filename, span=partial_checksum_span):
+    partial = PartialChecksum(span)
     with open(filename, 'rb') as f:
-        return hashlib.sha1(f.read()).hexdigest()
+        partial.update(f.read(span))
+        f.seek(max(f.tell(), os.fstat(f.fileno()).st_size - span))
+        partial.update(f.read(span))
+    return partial.hexdigest()
+
+# The stat fields that must be unchanged for cached checksums of a
+# file to still be valid:
+def file_cache_key(filename):
+    st = os.stat(str(filename))
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def md5sum(filename):
+    return file_checksums(filename, ('md5',))['md5']
+
+def sha1sum(filename):
+    return file_checksums(filename, ('sha1',))['sha1']
+
+# A connection pool for downloading from the Flickr farm servers.
+# Create one and reuse it, so that the TLS handshake isn't repeated
+# for every photo.
+def farm_pool(maxsize=1):
+    import certifi
+    import urllib3
+    return urllib3.PoolManager(maxsize=maxsize,
+                               cert_reqs='CERT_REQUIRED',
+                               ca_certs=certifi.where())
+
+# Stream a URL into the digest objects, a chunk at a time, rather than
+# loading the whole response into memory:
+def url_checksums(pool, url, algorithms=checksum_algorithms):
+    with metrics.timer('download'):
+        response = pool.request('GET', url, preload_content=False)
+        try:
+            if response.status != 200:
+                raise HTTPStatusError(response.status, url)
+            return chunks_checksums(counted(response.stream(checksum_chunk_size), 'download_bytes'),
+                                    algorithms)
+        finally:
+            response.release_conn()
+
+# The local database of photos we know the checksums of:
+checksum_db_filename = os.path.join(os.environ['HOME'],'.flickr-photos-checksummed.db')
+
+# A Bloom filter of the md5s in that database (see digest_index.py):
+checksum_bloom_filename = os.path.join(os.environ['HOME'],'.flickr-photos-checksummed.bloom')
+
+# Where the Flickr API rate limit is kept track of, between processes:
+rate_limit_db_filename = os.path.join(os.environ['HOME'],'.flickr-api-rate-limit.db')
+
+# Where the answers to some Flickr API calls are cached (see
+# flickr_checksum_tags.ApiCache):
+api_cache_db_filename = os.path.join(os.environ['HOME'],'.flickr-api-cache.db')
 
 checksum_pattern = "[0-9a-f]{32,40}"
 
@@ -69,13 +205,109 @@ def short_url(photo_id):
     return "http://flic.kr/p/%s" % (encoded,)
 
 
-def expand_paths(patterns):
-    from pathlib import Path
+# Files that are kept next to photos but aren't photos themselves:
+sidecar_extensions = ('.xmp', '.json', '.thm')
+
+# Yield the files matched by 'patterns' as they are found.  A pattern
+# that is a directory matches every file with an extension below it;
+# anything else is treated as a glob pattern.  The files are filtered
+# by:
+#
+#   include_extensions - if given, only files with one of these
+#   exclude_extensions - no files with one of these
+#   include_globs      - if given, only files whose name or path matches one of these
+#   exclude_globs      - no files whose name or path matches one of these
+#   min_size           - no files smaller than this many bytes
+#   skip_hidden        - don't look in directories starting with '.'
+#   dedupe_hardlinks   - only yield the first path to each inode
+def scan_files(patterns, include_extensions=None, exclude_extensions=sidecar_extensions,
+               include_globs=None, exclude_globs=None, min_size=0, skip_hidden=False,
+               dedupe_hardlinks=True):
     import glob
-    paths = []
+    from fnmatch import fnmatch
+
+    def lower_extensions(extensions):
+        return tuple(e.lower() if e.startswith('.') else '.' + e.lower() for e in extensions)
+
+    if include_extensions:
+        include_extensions = lower_extensions(include_extensions)
+    exclude_extensions = lower_extensions(exclude_extensions or ())
+    seen_inodes = set()
+
+    def matches(path, name, globs):
+        return any(fnmatch(name, g) or fnmatch(path, g) for g in globs)
+
+    def wanted(path, name, st):
+        extension = os.path.splitext(name)[1].lower()
+        if include_extensions and extension not in include_extensions:
+            return False
+        if extension in exclude_extensions:
+            return False
+        if include_globs and not matches(path, name, include_globs):
+            return False
+        if exclude_globs and matches(path, name, exclude_globs):
+            return False
+        if st.st_size < min_size:
+            return False
+        if dedupe_hardlinks:
+            inode = (st.st_dev, st.st_ino)
+            if inode in seen_inodes:
+                return False
+            seen_inodes.add(inode)
+        return True
+
+    # Yield (path, name, stat) for each file with an extension in the
+    # tree below 'top', without following symlinks to directories:
+    def walk(top):
+        directories = [top]
+        while directories:
+            directory = directories.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not (skip_hidden and entry.name.startswith('.')):
+                        directories.append(entry.path)
+                elif '.' in entry.name and entry.is_file():
+                    yield entry.path, entry.name, entry.stat()
+
     for pattern in patterns:
         if os.path.isdir(pattern):
-            paths.extend(Path(pattern).glob('**/*.*'))
+            candidates = walk(pattern)
         else:
-            paths.extend(glob.glob(pattern))
-    return paths
+            candidates = ((path, os.path.basename(path), os.stat(path))
+                          for path in glob.iglob(pattern) if os.path.isfile(path))
+        for path, name, st in candidates:
+            if wanted(path, name, st):
+                yield path
+
+# Add the options for scan_files() to an ArgumentParser:
+def add_scan_arguments(parser):
+    parser.add_argument('--include-ext', dest='include_extensions', action='append',
+                        metavar='EXT', help='only consider files with extension EXT')
+    parser.add_argument('--exclude-ext', dest='exclude_extensions', action='append',
+                        default=list(sidecar_extensions), metavar='EXT',
+                        help='ignore files with extension EXT (default: ' + ', '.join(sidecar_extensions) + ')')
+    parser.add_argument('--include', dest='include_globs', action='append',
+                        metavar='GLOB', help='only consider files whose name or path matches GLOB')
+    parser.add_argument('--exclude', dest='exclude_globs', action='append',
+                        metavar='GLOB', help='ignore files whose name or path matches GLOB')
+    parser.add_argument('--min-size', dest='min_size', type=int, default=0,
+                        metavar='BYTES', help='ignore files smaller than BYTES')
+    parser.add_argument('--skip-hidden', dest='skip_hidden', default=False, action='store_true',
+                        help='don\'t look in hidden directories')
+
+# Scan the files given on the command line, filtered according to the
+# options added by add_scan_arguments():
+def expand_paths(patterns, args=None):
+    if args is None:
+        return scan_files(patterns)
+    return scan_files(patterns,
+                      include_extensions=args.include_extensions,
+                      exclude_extensions=args.exclude_extensions,
+                      include_globs=args.include_globs,
+                      exclude_globs=args.exclude_globs,
+                      min_size=args.min_size,
+                      skip_hidden=args.skip_hidden)
@@ -0,0 +1,388 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A compact, read-only set of digests, for checking very many files
+# against the local database without a query per file.  The digests
+# are kept as one sorted block of raw bytes (16 bytes per MD5, so 1M
+# photos take 16 MB) and looked up by binary search.  The block can be
+# saved to a file and memory-mapped back, which is almost instant.
+#
+# Also here: a Bloom filter of the same digests, and snapshots of the
+# whole done table for copying it between machines, both in the same
+# kind of memory-mappable file.
+
+import mmap
+import os
+import struct
+
+MAGIC = b'FLKDIDX1'
+
+# Magic, digest width, number of digests and the fingerprint of the
+# database the index was built from:
+header = struct.Struct('<8sIQQQ')
+
+
+class DigestIndex:
+    def __init__(self, data, width, fingerprint=(0, 0), offset=0):
+        self.data = data
+        self.width = width
+        self.offset = offset
+        self.n_digests = (len(data) - offset) // width
+        self.fingerprint = tuple(fingerprint)
+
+    # Build an index from hex digests, e.g. ['d41d8cd98f00b204...', ...]:
+    @classmethod
+    def from_hex(cls, hex_digests, width=16, fingerprint=(0, 0)):
+        digests = sorted(set(bytes.fromhex(d) for d in hex_digests if d and len(d) == 2 * width))
+        return cls(b''.join(digests), width, fingerprint)
+
+    # Build an index of the 'column' ('md5' or 'sha1') of the done table.
+    # The database returns them sorted (lower case hex sorts the same
+    # as the raw bytes), so they can go straight into the block without
+    # holding a Python object per digest.
+    @classmethod
+    def from_db(cls, db, column='md5'):
+        width = 16 if column == 'md5' else 20
+        data = bytearray()
+        for d in db.digests(column):
+            if len(d) == 2 * width:
+                data += bytes.fromhex(d)
+        return cls(bytes(data), width, db.fingerprint())
+
+    def __len__(self):
+        return self.n_digests
+
+    def __contains__(self, hex_digest):
+        if len(hex_digest) != 2 * self.width:
+            return False
+        digest = bytes.fromhex(hex_digest)
+        data, width, offset = self.data, self.width, self.offset
+        low, high = 0, self.n_digests
+        while low < high:
+            middle = (low + high) // 2
+            start = offset + middle * width
+            if data[start:start + width] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        start = offset + low * width
+        return low < self.n_digests and data[start:start + width] == digest
+
+    def save(self, filename):
+        temporary_filename = filename + '.tmp'
+        with open(temporary_filename, 'wb') as f:
+            f.write(header.pack(MAGIC, self.width, self.n_digests, *self.fingerprint))
+            f.write(self.data[self.offset:self.offset + self.n_digests * self.width])
+        os.replace(temporary_filename, filename)
+
+    # Memory-map an index written by save().  Returns None if the file
+    # is missing or isn't an index.
+    @classmethod
+    def load(cls, filename):
+        try:
+            with open(filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(data) < header.size:
+            return None
+        magic, width, n_digests, count, version = header.unpack_from(data)
+        if magic != MAGIC or len(data) < header.size + n_digests * width:
+            return None
+        return cls(data, width, (count, version), offset=header.size)
+
+
+# Return an index of the md5s in the database, from 'filename' if that
+# was saved from the database as it is now, otherwise built afresh
+# (and saved to 'filename', if given):
+def md5_index(db, filename=None):
+    if filename:
+        index = DigestIndex.load(filename)
+        if index is not None and index.fingerprint == db.fingerprint():
+            return index
+    index = DigestIndex.from_db(db, 'md5')
+    if filename:
+        index.save(filename)
+    return index
+
+
+BLOOM_MAGIC = b'FLKBLOM1'
+
+# Magic, number of bits, number of hashes and the fingerprint of the
+# database the filter was built from:
+bloom_header = struct.Struct('<8sQIQQ')
+
+
+# A Bloom filter of digests.  If a digest isn't in it, it definitely
+# isn't in the database it was built from; if it is, it probably is
+# (with a 'false_positive_rate' chance that it isn't).  MD5s are
+# already uniformly distributed, so the bit positions are taken from
+# the digest itself rather than hashed again.
+class BloomFilter:
+    def __init__(self, n_bits, n_hashes, bits=None, fingerprint=(0, 0), offset=0):
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.bits = bits if bits is not None else bytearray((n_bits + 7) // 8)
+        self.offset = offset
+        self.fingerprint = tuple(fingerprint)
+
+    @classmethod
+    def for_size(cls, n_items, false_positive_rate=0.01, fingerprint=(0, 0)):
+        import math
+        n_items = max(n_items, 1)
+        n_bits = int(math.ceil(-n_items * math.log(false_positive_rate) / math.log(2) ** 2))
+        n_hashes = max(1, int(round(float(n_bits) / n_items * math.log(2))))
+        return cls(n_bits, n_hashes, fingerprint=fingerprint)
+
+    @classmethod
+    def from_db(cls, db, column='md5', false_positive_rate=0.01):
+        fingerprint = db.fingerprint()
+        bloom = cls.for_size(fingerprint[0], false_positive_rate, fingerprint)
+        bits, n_bits, hashes = bloom.bits, bloom.n_bits, range(bloom.n_hashes)
+        for hex_digest in db.digests(column):
+            digest = bytes.fromhex(hex_digest)
+            h1 = int.from_bytes(digest[:8], 'little')
+            h2 = int.from_bytes(digest[8:16], 'little') | 1
+            for i in hashes:
+                position = (h1 + i * h2) % n_bits
+                bits[position >> 3] |= 1 << (position & 7)
+        return bloom
+
+    def positions(self, hex_digest):
+        digest = bytes.fromhex(hex_digest)
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, hex_digest):
+        for position in self.positions(hex_digest):
+            self.bits[self.offset + position // 8] |= 1 << (position % 8)
+
+    # Add a digest that has just been added to 'db', and save the
+    # filter as built from the database as it is now, so that it isn't
+    # built again next time.  Only for a filter that was up to date
+    # before the digest was added.
+    def add_and_save(self, hex_digest, db, filename):
+        self.add(hex_digest)
+        self.fingerprint = db.fingerprint()
+        self.save(filename)
+
+    def __contains__(self, hex_digest):
+        bits, offset = self.bits, self.offset
+        return all(bits[offset + position // 8] & (1 << (position % 8))
+                   for position in self.positions(hex_digest))
+
+    def save(self, filename):
+        temporary_filename = filename + '.tmp'
+        with open(temporary_filename, 'wb') as f:
+            f.write(bloom_header.pack(BLOOM_MAGIC, self.n_bits, self.n_hashes, *self.fingerprint))
+            f.write(self.bits[self.offset:])
+        os.replace(temporary_filename, filename)
+
+    # Memory-map a filter written by save().  Returns None if the file
+    # is missing or isn't a Bloom filter.  Digests added to it only
+    # change the file once it's saved again.
+    @classmethod
+    def load(cls, filename):
+        try:
+            with open(filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return None
+        if len(data) < bloom_header.size:
+            return None
+        magic, n_bits, n_hashes, count, version = bloom_header.unpack_from(data)
+        if magic != BLOOM_MAGIC or len(data) < bloom_header.size + (n_bits + 7) // 8:
+            return None
+        return cls(n_bits, n_hashes, data, (count, version), offset=bloom_header.size)
+
+
+# Return a Bloom filter of the md5s in the database, from 'filename'
+# if that was saved from the database as it is now, otherwise built
+# afresh and saved to 'filename':
+def md5_bloom_filter(db, filename, rebuild=False):
+    if not rebuild:
+        bloom = BloomFilter.load(filename)
+        if bloom is not None and bloom.fingerprint == db.fingerprint():
+            return bloom
+    bloom = BloomFilter.from_db(db, 'md5')
+    bloom.save(filename)
+    return bloom
+
+
+SNAPSHOT_MAGIC = b'FLKSNAP1'
+
+# Magic, number of photos, number of SHA1s, and the SHA-256 of
+# everything after the header:
+snapshot_header = struct.Struct('<8sQQ32s')
+
+# Each photo, sorted by MD5, with a missing checksum
+# as all zero bytes:
+snapshot_record = struct.Struct('<16s20sQ')
+
+# Each SHA1, sorted, with the number of the record it belongs to:
+snapshot_sha1_entry = struct.Struct('<20sQ')
+
+
+# The sha256 of 'data' from 'offset' on, hashed a slice at a time, so
+# that a memory-mapped file isn't copied into memory all at once:
+def content_digest(data, offset, slice_size=1024 * 1024):
+    import hashlib
+    content_hash = hashlib.sha256()
+    with memoryview(data) as view:
+        for start in range(offset, len(data), slice_size):
+            content_hash.update(view[start:start + slice_size])
+    return content_hash.digest()
+
+
+# A snapshot of the checksums in the done table, in a compact file of
+# fixed-width records that can be copied to another machine, looked
+# up in (by memory-mapping it and binary search, without SQLite), and
+# merged into the database there:
+#
+#   Snapshot.write(db, 'checksums.snapshot')
+#   snapshot = Snapshot.load('checksums.snapshot')
+#   snapshot.find(md5='...')        # => ['1234', ...]
+#   db.upsert_many_to_done(snapshot.records())
+class Snapshot:
+    def __init__(self, data, n_records, n_sha1s):
+        self.data = data
+        self.n_records = n_records
+        self.n_sha1s = n_sha1s
+        self.records_offset = snapshot_header.size
+        self.sha1s_offset = self.records_offset + n_records * snapshot_record.size
+
+    # Write a snapshot of 'db' to 'filename'.  The rows are streamed
+    # out of the database in the order they are written, so the whole
+    # table is never held in memory.
+    @classmethod
+    def write(cls, db, filename):
+        import hashlib
+        content_hash = hashlib.sha256()
+        temporary_filename = filename + '.tmp'
+        # The order the md5 index already has the rows in:
+        order = "md5, rowid"
+        cursor = db.connection.cursor()
+        n_records = n_sha1s = 0
+        with open(temporary_filename, 'wb') as f:
+            f.write(bytes(snapshot_header.size))
+            for photo_id, md5, sha1 in cursor.execute(
+                    "SELECT photo_id, md5, sha1 FROM done ORDER BY " + order):
+                record = snapshot_record.pack(raw_digest(md5, 16), raw_digest(sha1, 20),
+                                              int(photo_id))
+                f.write(record)
+                content_hash.update(record)
+                n_records += 1
+            for sha1, number in cursor.execute(
+                    "SELECT sha1, number FROM "
+                    "( SELECT sha1, row_number() OVER (ORDER BY " + order + ") - 1 AS number "
+                    "  FROM done ) "
+                    "WHERE length(sha1) = 40 ORDER BY sha1"):
+                entry = snapshot_sha1_entry.pack(bytes.fromhex(sha1), number)
+                f.write(entry)
+                content_hash.update(entry)
+                n_sha1s += 1
+            f.seek(0)
+            f.write(snapshot_header.pack(SNAPSHOT_MAGIC, n_records, n_sha1s,
+                                         content_hash.digest()))
+        os.replace(temporary_filename, filename)
+        return n_records
+
+    # Memory-map a snapshot written by write().  Raises ValueError if
+    # the file isn't a snapshot, or (if 'verify' is set) has been
+    # damaged.
+    @classmethod
+    def load(cls, filename, verify=True):
+        with open(filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(data) < snapshot_header.size:
+            raise ValueError("{0} is not a checksum snapshot".format(filename))
+        magic, n_records, n_sha1s, expected_hash = snapshot_header.unpack_from(data)
+        size = (snapshot_header.size + n_records * snapshot_record.size
+                + n_sha1s * snapshot_sha1_entry.size)
+        if magic != SNAPSHOT_MAGIC or len(data) != size:
+            raise ValueError("{0} is not a checksum snapshot".format(filename))
+        if verify and content_digest(data, snapshot_header.size) != expected_hash:
+            raise ValueError("{0} is damaged (its content hash doesn't match)".format(filename))
+        return cls(data, n_records, n_sha1s)
+
+    def __len__(self):
+        return self.n_records
+
+    def record(self, number):
+        md5, sha1, photo_id = snapshot_record.unpack_from(
+            self.data, self.records_offset + number * snapshot_record.size)
+        return str(photo_id), hex_digest(md5), hex_digest(sha1)
+
+    # Yield (photo_id, md5, sha1) for every photo, in order of MD5:
+    def records(self):
+        for number in range(self.n_records):
+            yield self.record(number)
+
+    # The first of 'n' fixed-width entries from 'offset' whose first
+    # 'width' bytes aren't less than 'digest':
+    def lower_bound(self, offset, entry_size, n, digest):
+        low, high = 0, n
+        width = len(digest)
+        while low < high:
+            middle = (low + high) // 2
+            start = offset + middle * entry_size
+            if self.data[start:start + width] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # The ids of the photos with this md5 or sha1:
+    def find(self, md5=None, sha1=None):
+        photo_ids = []
+        if md5:
+            digest = bytes.fromhex(md5)
+            number = self.lower_bound(self.records_offset, snapshot_record.size,
+                                      self.n_records, digest)
+            while number < self.n_records:
+                photo_id, record_md5, _ = self.record(number)
+                if record_md5 != md5:
+                    break
+                photo_ids.append(photo_id)
+                number += 1
+        elif sha1:
+            digest = bytes.fromhex(sha1)
+            number = self.lower_bound(self.sha1s_offset, snapshot_sha1_entry.size,
+                                      self.n_sha1s, digest)
+            while number < self.n_sha1s:
+                entry_sha1, record_number = snapshot_sha1_entry.unpack_from(
+                    self.data, self.sha1s_offset + number * snapshot_sha1_entry.size)
+                if entry_sha1 != digest:
+                    break
+                photo_ids.append(self.record(record_number)[0])
+                number += 1
+        return photo_ids
+
+    # So that a snapshot can be used as the 'index' of
+    # find_not_uploaded.is_not_uploaded():
+    def __contains__(self, md5):
+        return len(md5) == 32 and bool(self.find(md5=md5))
+
+
+# The raw bytes of a hex digest of 'width' bytes, or zeros if there's
+# no (proper) digest:
+def raw_digest(digest, width):
+    if digest and len(digest) == 2 * width:
+        return bytes.fromhex(digest)
+    return bytes(width)
+
+def hex_digest(raw):
+    if raw.count(0) == len(raw):
+        return None
+    return raw.hex()
@@ -24,35 +24,39 @@ import re
 import xml
 import tempfile
 import time
+import functools
 from subprocess import call, Popen, PIPE
-import flickrapi
-from optparse import OptionParser
+from argparse import ArgumentParser
 from common import *
-import urllib.request, urllib.error, urllib.parse
-import contextlib
-
-parser = OptionParser(usage="Usage: %prog [OPTIONS] <FLICKR-USERNAME>")
-options,args = parser.parse_args()
-
-if len(args) != 1:
-    parser.print_help()
-    sys.exit(1)
-
-flickr = flickrapi.FlickrAPI(configuration['api_key'],configuration['api_secret'])
-
-(token, frob) = flickr.get_token_part_one(perms='write')
-if not token:
-    input("Press 'Enter' after you have authorized this program")
-flickr.get_token_part_two((token, frob))
+from metrics import metrics, add_metrics_arguments, start_metrics
+from flickr_checksum_tags import LazyFlickr, add_api_cache_arguments, cached_flickr
+from retry import HTTPStatusError, AdaptiveLimit, call_with_retries
+from concurrent.futures import ThreadPoolExecutor
+
+parser = ArgumentParser()
+parser.add_argument('username', metavar='FLICKR-USERNAME')
+parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=4,
+                    metavar='N', help='download N photos at a time')
+parser.add_argument('-q', '--quiet', dest='quiet', default=False, action='store_true',
+                    help="don't print progress for every photo")
+add_metrics_arguments(parser)
+add_api_cache_arguments(parser)
+options = parser.parse_args()
+args = [options.username]
+start_metrics(options)
+
+flickr = cached_flickr(LazyFlickr(perms='read'), options)
 
 # Return the Flickr NSID for a username or alias:
 def get_nsid(username_or_alias):
+    from flickrapi.exceptions import FlickrError
+
     try:
         # If someone provides their real username (i.e. [USERNAME] in
         # "About [USERNAME]" on their profile page, then this call
         # should work:
         user = flickr.people_findByUsername(username=username_or_alias)
-    except flickrapi.exceptions.FlickrError:
+    except FlickrError:
         # However, people who've set an alias for their Flickr URLs
         # sometimes think their username is that alias, so try that
         # afterwards.  (That's [ALIAS] in
@@ -61,7 +65,7 @@ def get_nsid(username_or_alias):
             username = flickr.urls_lookupUser(url="http://www.flickr.com/people/"+username_or_alias)
             user_id = username.getchildren()[0].getchildren()[0].text
             user = flickr.people_findByUsername(username=user_id)
-        except flickrapi.exceptions.FlickrError as e:
+        except FlickrError as e:
             return None
     return user.getchildren()[0].attrib['nsid']
 
@@ -79,6 +83,61 @@ def info_to_url(info_result,size=""):
     else:
         raise Exception("Unknown size ("+size+") passed to info_to_url()")
 
+def progress(*message):
+    if not options.quiet:
+        print(*message)
+
+# Return the size code, file format and URL to download for a photo
+# element from favorites_getPublicList, preferring the original:
+def photo_to_url(photo):
+    a = photo.attrib
+    if 'url_o' in a:
+        return ('o', a.get('originalformat', 'jpg'), a['url_o'])
+    elif 'url_b' in a:
+        return ('b', 'jpg', a['url_b'])
+    else:
+        # Neither was in the list, so ask for the details:
+        info_result = flickr.photos_getInfo(photo_id=a['id'])
+        if original_available(info_result):
+            size = 'o'
+        else:
+            size = 'b'
+        photo_format, farm_url = info_to_url(info_result, size)
+        return (size, photo_format, farm_url)
+
+# Download 'url' to 'filename', a chunk at a time.  The data goes to a
+# temporary file first, so that an interrupted download never leaves
+# a partial file under the real name.  If the file is already there
+# with the right size it isn't downloaded again, so this is safe to
+# retry.
+def download(pool, url, filename):
+    if os.path.exists(filename):
+        response = pool.request('HEAD', url)
+        if response.headers.get('Content-Length') == str(os.path.getsize(filename)):
+            progress("  Already downloaded:", filename)
+            return
+    with metrics.timer('download'):
+        response = pool.request('GET', url, preload_content=False)
+        try:
+            if response.status != 200:
+                raise HTTPStatusError(response.status, url)
+            fd, temporary_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                                      prefix='.'+os.path.basename(filename))
+            try:
+                with os.fdopen(fd, "wb") as ofp:
+                    for chunk in counted(response.stream(checksum_chunk_size), 'download_bytes'):
+                        ofp.write(chunk)
+                # mkstemp() makes the file readable by us alone; give it
+                # the permissions open() would have:
+                os.chmod(temporary_filename, 0o666 & ~umask)
+                os.replace(temporary_filename, filename)
+            except BaseException:
+                os.remove(temporary_filename)
+                raise
+        finally:
+            response.release_conn()
+    progress("  Downloaded:", filename)
+
 nsid = get_nsid(args[0])
 if not nsid:
     print("Couldn't find the username or alias '"+args[0])
@@ -89,29 +148,49 @@ print("Got nsid: %s for '%s'" % ( nsid, args[0] ))
 per_page = 100
 page = 1
 
-while True:
-
-    response = flickr.favorites_getPublicList(user_id=nsid, per_page=per_page, page=page)
-
-    photo_elements = response.getchildren()[0]
-    for photo in photo_elements:
-        title = photo.attrib['title']
-        photo_id = photo.attrib['id']
-        print("Title:", title)
-        info_result = flickr.photos_getInfo(photo_id=photo_id)
-        if original_available(info_result):
-            size = 'o'
-        else:
-            size = 'b'
-        photo_format, farm_url = info_to_url(info_result, size)
-        print("  Farm URL:", farm_url)
-        safe_title = re.sub('[ /]', '_', title)
-        filename = "%s-%s-%s.%s" % (size, photo_id, safe_title, photo_format)
-        if not os.path.exists(filename):
-            with contextlib.closing(urllib.request.urlopen(farm_url)) as ifp:
-                with open(filename, "w") as ofp:
-                    ofp.write(ifp.read())
-
-    if len(photo_elements) < per_page:
-        break
-    page += 1
+pool = farm_pool(maxsize=options.jobs)
+# The umask can only be read by setting it, which isn't safe to do
+# from the download threads:
+umask = os.umask(0)
+os.umask(umask)
+# Fewer downloads run at once while the farm servers are struggling:
+limit = AdaptiveLimit(options.jobs)
+failed = 0
+
+with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+    while True:
+
+        response = flickr.favorites_getPublicList(user_id=nsid, per_page=per_page, page=page,
+                                                  extras='url_o,url_b,original_format')
+
+        photo_elements = response.getchildren()[0]
+        downloads = []
+        for photo in photo_elements:
+            title = photo.attrib['title']
+            photo_id = photo.attrib['id']
+            progress("Title:", title)
+            size, photo_format, farm_url = photo_to_url(photo)
+            progress("  Farm URL:", farm_url)
+            safe_title = re.sub('[ /]', '_', title)
+            filename = "%s-%s-%s.%s" % (size, photo_id, safe_title, photo_format)
+            metrics.count('photos')
+            downloads.append((filename, executor.submit(
+                call_with_retries, 'farm', functools.partial(download, pool, farm_url, filename),
+                limit=limit)))
+        # A photo that still fails after being retried is skipped, so
+        # that the rest are downloaded anyway:
+        for filename, future in downloads:
+            try:
+                future.result()
+            except Exception as e:
+                print("Failed to download {0}: {1}".format(filename, e), file=sys.stderr)
+                metrics.count('failures')
+                failed += 1
+
+        if len(photo_elements) < per_page:
+            break
+        page += 1
+
+if failed:
+    print("{0} photos failed to download; run again to retry them".format(failed), file=sys.stderr)
+    sys.exit(1)
@@ -23,26 +23,76 @@ import os
 import sys
 import re
 from argparse import ArgumentParser
-from flickr_checksum_tags import get_photo_by_checksum, PhotoNotFound, MultiplePhotosFound, SqliteDb
-from common import configuration, expand_paths, md5sum
-import flickrapi
+from flickr_checksum_tags import get_photo_by_checksum, PhotoNotFound, MultiplePhotosFound, SqliteDb, LazyFlickr
+from common import expand_paths, add_scan_arguments, checksum_db_filename, checksum_bloom_filename, file_cache_key, file_checksums, partial_checksum
+from metrics import metrics, add_metrics_arguments, start_metrics
+from digest_index import md5_index, md5_bloom_filter, Snapshot
 import glob
 
 
-def is_not_uploaded(filename, db, flickr, verbose=False):
+# If the caller has already calculated the checksums of the file (see
+# common.file_checksums) they can be passed in, so that the file is
+# only read once.  If 'flickr' is None, only the local database is
+# checked (run "flickr_checksum_tags.py --sync" to fill it first).  If
+# 'index' is given (a digest_index.DigestIndex of the md5s in the
+# database) it is used instead of querying the database.  If 'bloom'
+# is given (a digest_index.BloomFilter of the same, which
+# flickr-upload.py keeps up to date as it records uploads) a file that
+# isn't in it is taken not to be uploaded without looking any further.
+# If 'snapshot' is given (a digest_index.Snapshot) the photos in it
+# count as uploaded as well.  'verbose' only changes what's printed,
+# not the answer.  If 'quick' is set, a file whose size and partial
+# checksum match no photo in the database is taken not to be uploaded
+# without reading all of it.
+def is_not_uploaded(filename, db, flickr, verbose=False, checksums=None, index=None, bloom=None,
+                    quick=False, snapshot=None):
+    if quick and ruled_out(filename, db):
+        metrics.count('photos')
+        if verbose:
+            print("filename was: "+str(filename))
+            print("  ... not uploaded")
+        return True
+
     # Calculate md5 checksum.
-    md5 = md5sum(filename)
+    if checksums is None:
+        checksums = db.file_checksums(filename)
+    md5 = checksums['md5']
+    metrics.count('photos')
     if verbose:
-        print("filename was: "+filename)
+        print("filename was: "+str(filename))
         print("with md5 sum: "+md5)
     
+    in_snapshot = snapshot is not None and md5 in snapshot
+    if bloom is not None and md5 not in bloom and not in_snapshot:
+        metrics.count('bloom_negatives')
+        if verbose:
+            print("  ... not uploaded")
+        return True
+
+    # Found, and we don't need to know which photo it is:
+    if (in_snapshot or (index is not None and md5 in index)) and not verbose:
+        return False
+
     try:
         # First, look for entry in the local database.
-        db_entries = db.find(md5=md5)
+        if index is not None and md5 not in index:
+            db_entries = []
+        else:
+            db_entries = db.find(md5=md5)
         if len(db_entries) == 1:
             photo_id = db_entries[0]['photo_id']
+            # Remember the size, so that --quick can rule files out:
+            if db_entries[0]['size'] is None:
+                db.set_size(photo_id, os.path.getsize(filename), partial_checksum(filename))
         elif len(db_entries) > 1:
             raise MultiplePhotosFound()
+        elif in_snapshot:
+            photo_ids = snapshot.find(md5=md5)
+            if len(photo_ids) > 1:
+                raise MultiplePhotosFound()
+            photo_id = photo_ids[0]
+        elif flickr is None:
+            raise PhotoNotFound()
         else:
             # No entry found, try to find it on Flickr.
             photo = get_photo_by_checksum(flickr, md5=md5)
@@ -61,24 +111,166 @@ def is_not_uploaded(filename, db, flickr, verbose=False):
     return False
 
 
+# Whether no photo in the database has the size and partial checksum
+# of the file, so that it can't have been uploaded.  (Photos whose
+# size we don't know can't be ruled out like this; they get one once
+# a local copy has been found by its full checksum.)
+def ruled_out(filename, db):
+    size = os.path.getsize(filename)
+    if db.has_size(size) and db.has_size(size, partial_checksum(filename)):
+        return False
+    metrics.count('quick_negatives')
+    return True
+
+
+def stat_and_checksum(filename):
+    key = file_cache_key(filename)
+    return key, file_checksums(filename)
+
+
+# Yield (filename, checksums) for each of 'paths', hashing up to 'jobs'
+# files at a time.  hashlib releases the GIL while hashing, so threads
+# are enough to keep all cores busy.  The cache is only touched from
+# the calling thread, since the database connection can't be shared.
+# Unless 'unordered' is set, the results come in the order of 'paths'.
+# Files for which skip(filename) is true aren't read, and come with
+# None for checksums.
+def checksums_in_parallel(paths, db, jobs, unordered=False, skip=None):
+    from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+    from collections import deque
+
+    # Don't queue up more than this many files at once:
+    max_pending = jobs * 4
+
+    def finish(item):
+        filename, checksums, future = item
+        if future is not None:
+            key, checksums = future.result()
+            db.add_file_checksums(filename, key, checksums)
+        return filename, checksums
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for filename in paths:
+            if skip is not None and skip(filename):
+                if unordered or not pending:
+                    yield filename, None
+                else:
+                    pending.append((filename, None, None))
+                continue
+            checksums = db.cached_file_checksums(filename)
+            if checksums is not None and (unordered or not pending):
+                yield filename, checksums
+                continue
+            future = None
+            if checksums is None:
+                future = executor.submit(stat_and_checksum, filename)
+            pending.append((filename, checksums, future))
+            if len(pending) < max_pending:
+                continue
+            if unordered:
+                wait([item[2] for item in pending], return_when=FIRST_COMPLETED)
+                for item in [item for item in pending if item[2].done()]:
+                    pending.remove(item)
+                    yield finish(item)
+            else:
+                yield finish(pending.popleft())
+        if unordered:
+            items = dict((item[2], item) for item in pending)
+            for future in as_completed(items):
+                yield finish(items[future])
+        else:
+            for item in pending:
+                yield finish(item)
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument('photos', nargs='+', metavar='PHOTO')
     parser.add_argument('-v', '--verbose', dest='verbose', default=False,
                     action='store_true',
                     help='Turn on verbose output')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                    metavar='N',
+                    help='Calculate checksums of N files at a time (0 means one per CPU)')
+    parser.add_argument('--unordered', dest='unordered', default=False,
+                    action='store_true',
+                    help='With --jobs, print files as soon as they are checked '
+                         'rather than in the order given')
+    parser.add_argument('--offline', dest='offline', default=False,
+                    action='store_true',
+                    help='Only look in the local database, not on Flickr')
+    parser.add_argument('--memory-index', dest='memory_index', default=False,
+                    action='store_true',
+                    help='Load all md5s from the local database into memory at startup, '
+                         'rather than querying it for every file')
+    parser.add_argument('--index-file', dest='index_file', metavar='FILENAME',
+                    help='With --memory-index, keep the index in FILENAME and '
+                         'memory-map it on later runs (rebuilt when the database changes)')
+    parser.add_argument('--snapshot', dest='snapshot', metavar='FILENAME',
+                    help='Also count files whose md5 is in the checksum snapshot FILENAME '
+                         '(from flickr_checksum_tags.py --export-snapshot) as uploaded')
+    parser.add_argument('--bloom', dest='bloom', default=False,
+                    action='store_true',
+                    help='Take files whose md5 is not in the Bloom filter of the local '
+                         'database to be not uploaded, without asking Flickr.  Only use '
+                         'this if the database is kept up to date with --sync.')
+    parser.add_argument('--quick', dest='quick', default=False,
+                    action='store_true',
+                    help='Take files whose size and first and last 64 KB match no photo '
+                         'in the local database to be not uploaded, without reading them '
+                         'in full.  Only photos uploaded with flickr-upload.py, tagged with '
+                         'flickr_checksum_tags.py -a or found locally before have a size.')
+    add_scan_arguments(parser)
+    add_metrics_arguments(parser)
     args = parser.parse_args()
-    paths = expand_paths(args.photos)
+    start_metrics(args)
+    jobs = args.jobs or os.cpu_count() or 1
+    paths = expand_paths(args.photos, args)
 
-    flickr = flickrapi.FlickrAPI(configuration['api_key'],configuration['api_secret'])
-    flickr.authenticate_via_browser(perms='write')
+    # Flickr is only connected to if a file isn't in the local database:
+    if args.offline:
+        flickr = None
+    else:
+        flickr = LazyFlickr(perms='write')
+
+    db = SqliteDb(checksum_db_filename)
 
-    db_filename = os.path.join(os.environ['HOME'],'.flickr-photos-checksummed.db')
-    db = SqliteDb(db_filename)
+    index = None
+    if args.memory_index or args.index_file:
+        index = md5_index(db, args.index_file)
+    snapshot = None
+    if args.snapshot:
+        try:
+            snapshot = Snapshot.load(args.snapshot)
+        except (IOError, ValueError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    bloom = None
+    if args.bloom:
+        bloom = md5_bloom_filter(db, checksum_bloom_filename)
+    if args.quick:
+        n_without_size = db.count_without_size()
+        if n_without_size:
+            print("Warning: {0} photos in the local database have no recorded size; "
+                  "--quick will report copies of them as not uploaded".format(n_without_size),
+                  file=sys.stderr)
 
-    for filename in paths:
-        if is_not_uploaded(filename, db, flickr, args.verbose):
-            print(filename)
+    with db.batch():
+        if jobs > 1:
+            skip = (lambda filename: ruled_out(filename, db)) if args.quick else None
+            for filename, checksums in checksums_in_parallel(paths, db, jobs, args.unordered, skip):
+                if checksums is None:
+                    metrics.count('photos')
+                    print(filename)
+                elif is_not_uploaded(filename, db, flickr, args.verbose, checksums=checksums, index=index, bloom=bloom,
+                                     snapshot=snapshot):
+                    print(filename)
+        else:
+            for filename in paths:
+                if is_not_uploaded(filename, db, flickr, args.verbose, index=index, bloom=bloom,
+                                   quick=args.quick, snapshot=snapshot):
+                    print(filename)
 
 if __name__ == '__main__':
     main()
@@ -19,17 +19,21 @@
 # This depends on a couple of packages:
 #   apt-get install python-pysqlite2 python-flickrapi
 
+import io
 import os
 import sys
 import re
+import time
 import xml
 import tempfile
 from subprocess import call, Popen, PIPE
-import flickrapi
 from argparse import ArgumentParser
 from common import *
-from flickr_checksum_tags import SqliteDb
+from metrics import metrics, add_metrics_arguments, start_metrics
+from flickr_checksum_tags import SqliteDb, LazyFlickr, throttler, get_photo_by_checksum, PhotoNotFound, MultiplePhotosFound
 from find_not_uploaded import is_not_uploaded
+from digest_index import md5_bloom_filter
+from retry import AdaptiveLimit, call_with_retries
 
 parser = ArgumentParser()
 parser.add_argument('paths', nargs='+', metavar='FILENAME', help="file to upload")
@@ -52,21 +56,53 @@ parser.add_argument('--date-taken', dest='date_taken',
                     help='set the date and time when the photo was taken')
 parser.add_argument('--reupload', action='store_true',
                     help="Don't check if already uploaded.")
+parser.add_argument('--offline-check', dest='offline_check', action='store_true',
+                    help="Only check the local database (not Flickr) for whether a file is already uploaded.")
+
+parser.add_argument('--bloom', dest='bloom', action='store_true',
+                    help="Upload files whose md5 is not in the Bloom filter of the local database "
+                         "without asking Flickr first.  Only use this if the database is kept up "
+                         "to date with flickr_checksum_tags.py --sync.")
+parser.add_argument('-q', '--quiet', dest='quiet', default=False, action='store_true',
+                    help="don't print the name of every file uploaded")
+parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, metavar='N',
+                    help="upload N files at a time (default: 1)")
+parser.add_argument('--watch', dest='watch', default=False, action='store_true',
+                    help="after uploading the files there are, keep running and upload new "
+                         "or changed files in the directories given")
+parser.add_argument('--settle', dest='settle', type=float, default=5.0, metavar='SECONDS',
+                    help="with --watch, only upload a file once it hasn't changed for "
+                         "SECONDS (default: 5)")
+parser.add_argument('--poll-interval', dest='poll_interval', type=float, default=30.0,
+                    metavar='SECONDS',
+                    help="with --watch, where inotify isn't available, look for new files "
+                         "every SECONDS (default: 30)")
+parser.add_argument('--queue-size', dest='queue_size', type=int, default=100, metavar='N',
+                    help="with --watch, queue at most N files for upload (default: 100)")
+add_scan_arguments(parser)
+add_metrics_arguments(parser)
 
 args = parser.parse_args()
-paths = expand_paths(args.paths)
+if args.watch:
+    for path in args.paths:
+        if not os.path.isdir(path):
+            parser.error("--watch needs directories to watch, but {0} isn't one".format(path))
+start_metrics(args)
+paths = expand_paths(args.paths, args)
 
 date_pattern = r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$'
-date_error_message = 'must be of the form "YYYY-MM-DD HH:MM:SS'
+date_error_message = 'must be of the form "YYYY-MM-DD HH:MM:SS"'
 
 if args.date_uploaded and not re.search(date_pattern,args.date_uploaded):
-    print("The --date-uploaded argument must be "+date_error_message)
+    print("The --date-uploaded argument "+date_error_message)
+    sys.exit(1)
 
 if args.date_taken and not re.search(date_pattern,args.date_taken):
-    print("The --date-taken argument must be "+date_error_message)
+    print("The --date-taken argument "+date_error_message)
+    sys.exit(1)
 
-flickr = flickrapi.FlickrAPI(configuration['api_key'],configuration['api_secret'])
-flickr.authenticate_via_browser(perms='write')
+# Only connected to once there's something to check or upload:
+flickr = LazyFlickr(perms='write')
 
 def progress(percent,done):
     if done and args.verbose:
@@ -74,37 +110,114 @@ def progress(percent,done):
     elif args.verbose:
         print(""+str(int(round(percent)))+"%")
 
-db_filename = os.path.join(os.environ['HOME'],'.flickr-photos-checksummed.db')
-db = SqliteDb(db_filename)
+db = SqliteDb(checksum_db_filename)
 
-for path in paths:
-    if args.reupload or is_not_uploaded(path, db, flickr):
-        pass  # Continue with the upload.
-    else:
-        if args.verbose:
-            print("Skipping {0} -- already uploaded".format(path))
-        continue
+bloom = None
+if args.bloom:
+    bloom = md5_bloom_filter(db, checksum_bloom_filename)
+
+# Whether 'path' (with these checksums) should be uploaded:
+def needs_upload(path, checksums):
+    lookup_flickr = None if args.offline_check else flickr
+    if args.reupload or is_not_uploaded(path, db, lookup_flickr, checksums=checksums, bloom=bloom):
+        return True
+    if args.verbose:
+        print("Skipping {0} -- already uploaded".format(path))
+    return False
+
+# A file that adds the number of bytes read from it to 'sent', so
+# that the progress of several uploads can be added up:
+class UploadFile(io.FileIO):
+    def __init__(self, filename, sent):
+        io.FileIO.__init__(self, filename, 'rb')
+        self.sent = sent
+
+    def read(self, size=-1):
+        data = io.FileIO.read(self, size)
+        self.sent(len(data))
+        return data
+
+# After an upload fails, we look for the photo on Flickr at these
+# delays (in seconds) before trying again, in case the upload got
+# through anyway.  Flickr's search doesn't find a new photo straight
+# away, so this makes a second copy much less likely but can't rule
+# it out.
+upload_check_delays = (0, 10, 20)
+
+# Wait for a photo with these checksums to turn up on Flickr, as
+# above.  Returns whether it did, and its photo_id (None if there's
+# more than one).
+def find_upload(checksums):
+    for delay in upload_check_delays:
+        time.sleep(delay)
+        try:
+            return True, get_photo_by_checksum(flickr, md5=checksums['md5']).attrib['id']
+        except PhotoNotFound:
+            pass
+        except MultiplePhotosFound:
+            return True, None
+    return False, None
 
-    real_sha1 = sha1sum(path)
-    real_md5 = md5sum(path)
+# Upload the file, returning the photo_id, or None if it turns out
+# to have been uploaded more than once already.  With 'sent', the
+# progress goes there rather than to progress(), and this is safe to
+# call from several threads at once.  An upload that fails with a
+# transient error is tried again once find_upload() hasn't found it.
+def send(path, checksums, sent=None, limit=None):
+    tags = sha1_machine_tag_prefix + checksums['sha1'] + " " + md5_machine_tag_prefix + checksums['md5']
 
-    tags = sha1_machine_tag_prefix + real_sha1 + " " + md5_machine_tag_prefix + real_md5
+    if not args.quiet and sent is None:
+        print("Uploading {0}".format(path))
+    # What find_upload() found before a retry:
+    uploaded = {}
 
-    print("Uploading {0}".format(path))
-    result = flickr.upload(filename=path,
-                        callback=progress,
-                        title=(args.title or os.path.basename(path)),
-                        tags=tags,
-                        is_public=int(args.public),
-                        is_family=int(args.family),
-                        is_friend=int(args.friends))
+    def check_uploaded():
+        found, photo_id = find_upload(checksums)
+        if found:
+            uploaded['photo_id'] = photo_id
 
-    photo_id = result.getchildren()[0].text
+    def attempt():
+        if 'photo_id' in uploaded:
+            return uploaded['photo_id']
+        throttler.register()
+        if sent is None:
+            metrics.count('upload_bytes', os.path.getsize(path))
+            result = flickr.upload(filename=path,
+                                callback=progress,
+                                title=(args.title or os.path.basename(path)),
+                                tags=tags,
+                                is_public=int(args.public),
+                                is_family=int(args.family),
+                                is_friend=int(args.friends))
+        else:
+            with UploadFile(path, sent) as f:
+                result = flickr.upload(filename=path,
+                                    fileobj=f,
+                                    title=(args.title or os.path.basename(path)),
+                                    tags=tags,
+                                    is_public=int(args.public),
+                                    is_family=int(args.family),
+                                    is_friend=int(args.friends))
+        metrics.count('photos_uploaded')
+        return result.getchildren()[0].text
+
+    return call_with_retries('upload', attempt, before_retry=check_uploaded, limit=limit)
+
+# Record an uploaded file in the database, and set its dates:
+def record(path, checksums, photo_id):
     if args.verbose:
         print("photo_id of uploaded photo: "+str(photo_id))
         print("Uploaded to: "+short_url(photo_id))
-    
-    db.add_to_done(photo_id, real_md5, real_sha1)
+
+    db.add_to_done(photo_id, checksums['md5'], checksums['sha1'],
+                   os.path.getsize(path), partial_checksum(path))
+    # Commit straight away, even inside db.batch(): if we're killed, a
+    # photo that is on Flickr but not in the database would be
+    # uploaded again by the next run with --offline-check or --bloom.
+    db.commit()
+    # Keep the filter current, since a miss in it is trusted:
+    if bloom is not None:
+        bloom.add_and_save(checksums['md5'], db, checksum_bloom_filename)
 
     if args.date_uploaded or args.date_taken:
         if args.verbose:
@@ -113,7 +226,164 @@ for path in paths:
                 print("  Date uploaded: "+args.date_uploaded)
             if args.date_taken:
                 print("  Date taken: "+args.date_taken)
+        throttler.register()
         result = flickr.photos_setDates(photo_id=photo_id,
                                         date_posted=args.date_uploaded,
                                         date_taken=args.date_taken,
                                         date_taken_granularity=0)
+
+# Upload one file, unless it's already uploaded:
+def upload(path):
+    # Read the file at most once (not at all if its checksums are
+    # cached), and use the digests both for the check and the tags.
+    checksums = db.file_checksums(path)
+    if needs_upload(path, checksums):
+        photo_id = send(path, checksums)
+        if photo_id is not None:
+            record(path, checksums, photo_id)
+
+# Whether a file with these checksums, which isn't in the local
+# database, is on Flickr anyway.  Unlike is_not_uploaded() this
+# doesn't touch the database, so it can run in any thread.
+def on_flickr(path, checksums):
+    if args.reupload or args.offline_check:
+        return False
+    if bloom is not None and checksums['md5'] not in bloom:
+        return False
+    try:
+        get_photo_by_checksum(flickr, md5=checksums['md5'])
+    except PhotoNotFound:
+        return False
+    except MultiplePhotosFound:
+        pass
+    if args.verbose:
+        print("Skipping {0} -- already uploaded".format(path))
+    return True
+
+# Upload 'paths', up to 'jobs' at a time.  The files are hashed and
+# looked up in the local database ahead of the uploads (see
+# checksums_in_parallel).  Looking them up on Flickr and uploading
+# them runs in a pool of threads, and as each one finishes it is
+# recorded in the database and its dates set from this thread, one at
+# a time.
+def upload_in_parallel(paths, jobs):
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    from find_not_uploaded import checksums_in_parallel
+    import threading
+
+    start = time.time()
+    totals = dict(files=0, bytes=0, failed=0)
+    lock = threading.Lock()
+    # Fewer uploads run at once while Flickr is struggling:
+    limit = AdaptiveLimit(jobs)
+
+    def sent(n_bytes):
+        metrics.count('upload_bytes', n_bytes)
+        with lock:
+            totals['bytes'] += n_bytes
+
+    def check_and_send(path, checksums):
+        if on_flickr(path, checksums):
+            return None
+        return send(path, checksums, sent, limit)
+
+    def finish(futures):
+        for future in futures:
+            path, checksums = uploads.pop(future)
+            try:
+                photo_id = future.result()
+                if photo_id is None:
+                    continue
+                record(path, checksums, photo_id)
+            except Exception as e:
+                # Carry on with the other files:
+                print("Failed to upload {0}: {1}".format(path, e), file=sys.stderr)
+                metrics.count('failures')
+                totals['failed'] += 1
+                continue
+            totals['files'] += 1
+            if not args.quiet:
+                megabytes = totals['bytes'] / 1e6
+                print("Uploaded {0} ({1} files, {2:.1f} MB, {3:.2f} MB/s, {4} in progress)".format(
+                    path, totals['files'], megabytes, megabytes / (time.time() - start),
+                    len(uploads)))
+
+    # The md5s of the files sent off so far.  A file isn't recorded in
+    # the database until its upload has finished, so without this a
+    # copy of a file that is still being uploaded would be uploaded too.
+    submitted = set()
+
+    with ThreadPoolExecutor(max_workers=jobs) as uploader:
+        uploads = {}
+        for path, checksums in checksums_in_parallel(paths, db, jobs, unordered=True):
+            if not args.reupload and (checksums['md5'] in submitted or
+                                      not is_not_uploaded(path, db, None, checksums=checksums)):
+                if args.verbose:
+                    print("Skipping {0} -- already uploaded".format(path))
+                continue
+            submitted.add(checksums['md5'])
+            uploads[uploader.submit(check_and_send, path, checksums)] = (path, checksums)
+            # Keep the pool busy, but don't run too far ahead of it:
+            if len(uploads) >= 2 * jobs:
+                finish(wait(list(uploads), return_when=FIRST_COMPLETED).done)
+        finish(list(uploads))
+    return totals['failed']
+
+
+# Keep running, uploading the files that turn up in the directories
+# given on the command line.  The watcher runs in a thread of its own
+# so that it keeps up with the changes while we upload, and hands the
+# files over through a bounded queue.
+def watch(watcher):
+    import queue
+    import threading
+
+    uploads = queue.Queue(maxsize=args.queue_size)
+
+    def produce():
+        for path in watcher:
+            uploads.put(path)
+
+    threading.Thread(target=produce, daemon=True).start()
+    if not args.quiet:
+        print("Watching for new files ({0})...".format(watcher.method()))
+    while True:
+        path = uploads.get()
+        try:
+            upload(path)
+        except Exception as e:
+            # Don't let one bad file stop the daemon:
+            print("Failed to upload {0}: {1}".format(path, e), file=sys.stderr)
+
+
+if args.watch:
+    from watch import Watcher
+    watcher = Watcher(args.paths, args, settle=args.settle, interval=args.poll_interval)
+    # Start watching before the first pass, so that nothing that
+    # turns up in the meantime is missed:
+    paths = watcher.start()
+
+# Commit the cached file checksums in batches rather than after every
+# file (uploads are committed as they're recorded):
+failed = 0
+with db.batch():
+    if args.jobs > 1:
+        failed = upload_in_parallel(paths, args.jobs)
+    else:
+        for path in paths:
+            try:
+                upload(path)
+            except Exception as e:
+                print("Failed to upload {0}: {1}".format(path, e), file=sys.stderr)
+                metrics.count('failures')
+                failed += 1
+
+if args.watch:
+    try:
+        watch(watcher)
+    except KeyboardInterrupt:
+        pass
+
+if failed:
+    print("{0} files failed to upload; run again to retry them".format(failed), file=sys.stderr)
+    sys.exit(1)
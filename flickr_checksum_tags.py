@@ -24,9 +24,13 @@ import re
 import xml
 import tempfile
 import time
+import contextlib
+import itertools
+import threading
 from subprocess import call, Popen, PIPE
-import flickrapi
 from common import *
+from metrics import metrics, Timed, add_metrics_arguments, start_metrics
+from retry import Retried, AdaptiveLimit, call_with_retries
 
 # There are more details about the meaning of these size
 # codes here:
@@ -38,87 +42,571 @@ v = [ '"'+x+'"' for x in valid_size_codes ]
 valid_size_codes_sentence = ", ".join(v[0:-1]) + " or " + v[-1]
 
 
+# A token bucket rate limiter for Flickr API calls.  Up to BURST calls
+# can be made straight away, after which calls are paced evenly so
+# that no more than MAX_REQUESTS_PER_PERIOD (less a safety margin) are
+# made per PERIOD_IN_SECONDS.
+#
+# It is safe to call register() from several threads.  After
+# share_state(), the bucket is kept in a small SQLite database so that
+# all processes using the same API key share the one budget.  That's a
+# separate file from the checksum database, because a batch of writes
+# there can hold its write lock for a long time.
 class Throttler:
     MAX_REQUESTS_PER_PERIOD = 3600
     PERIOD_IN_SECONDS = 3600
+    SAFETY_MARGIN = 10
+    BURST = 50
 
     def __init__(self):
-        self.reset()
-    
-    def register(self):
-        self.n_requests += 1
-        if self.n_requests > self.MAX_REQUESTS_PER_PERIOD - 10:
-            time_left = self.start + self.PERIOD_IN_SECONDS - time.time()
-            if time_left > 0:
-                sleep_time = int(time_left + 10)
-                print("Flickr API usage almost exceeded {0} within {2} seconds. Sleeping {1} seconds.".format(
-                    self.MAX_REQUESTS_PER_PERIOD, sleep_time, self.PERIOD_IN_SECONDS))
-                time.sleep(sleep_time)
-            self.reset()
-    
-    def reset(self):
+        self.lock = threading.Lock()
+        self.rate = float(self.MAX_REQUESTS_PER_PERIOD - self.SAFETY_MARGIN) / self.PERIOD_IN_SECONDS
+        self.tokens = float(self.BURST)
+        self.updated = time.time()
+        self.connection = None
+        # Statistics, for progress output:
         self.n_requests = 0
         self.start = time.time()
+        self.seconds_slept = 0.0
+
+    def share_state(self, db_filename):
+        from sqlite3 import dbapi2 as sqlite
+
+        connection = sqlite.connect(db_filename, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        connection.execute("CREATE TABLE IF NOT EXISTS `state` "
+                           "( `name` text primary key, "
+                           "  `value` text )")
+        # Only once the table is there, since other threads may be in
+        # register() already:
+        with self.lock:
+            self.connection = connection
+
+    def load(self):
+        row = self.connection.execute("SELECT value FROM state WHERE name = 'rate_limiter'").fetchone()
+        if row:
+            tokens, updated = row[0].split()
+            self.tokens, self.updated = float(tokens), float(updated)
+
+    def save(self):
+        self.connection.execute("INSERT OR REPLACE INTO state VALUES ( 'rate_limiter', ? )",
+                                ("%f %f" % (self.tokens, self.updated),))
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(float(self.BURST), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Call before every API request.  Takes a token from the bucket,
+    # sleeping until it would have been refilled if it was empty.
+    def register(self):
+        with self.lock:
+            if self.connection:
+                self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if self.connection:
+                    self.load()
+                self.refill()
+                self.tokens -= 1
+                if self.connection:
+                    self.save()
+            finally:
+                if self.connection:
+                    self.connection.execute("COMMIT")
+            self.n_requests += 1
+            sleep_time = max(0.0, -self.tokens / self.rate)
+            self.seconds_slept += sleep_time
+        # The token is ours already, so other callers can go ahead
+        # while we wait for it.
+        if sleep_time >= 60:
+            print("Flickr API usage almost exceeded {0} within {2} seconds. Sleeping {1} seconds.".format(
+                self.MAX_REQUESTS_PER_PERIOD, int(sleep_time), self.PERIOD_IN_SECONDS))
+        if sleep_time > 0:
+            metrics.count('throttle_sleeps')
+            with metrics.timer('throttle_sleep'):
+                time.sleep(sleep_time)
+
+    # The number of calls that can be made right now without waiting:
+    def remaining(self):
+        with self.lock:
+            if self.connection:
+                self.load()
+            self.refill()
+            return max(0, int(self.tokens))
 
 
 throttler = Throttler()
 
 
+# Per-photo progress messages, which --quiet turns off:
+show_progress = True
+
+def progress(message):
+    if show_progress:
+        print(message)
+
+
 class SqliteDb:
+    # Schema changes, applied in order to databases whose user_version
+    # is lower than the version number.  Only ever add to the end of
+    # this list.
+    migrations = [
+        (1, ["CREATE INDEX IF NOT EXISTS `done_md5` ON `done` (`md5`)",
+             "CREATE INDEX IF NOT EXISTS `done_sha1` ON `done` (`sha1`)"]),
+        (2, ["CREATE TABLE IF NOT EXISTS `state` "
+             "( `name` text primary key, "
+             "  `value` text )"]),
+        # The size and partial_checksum() of the file, where we know
+        # them, to rule files out without reading them in full:
+        (3, ["ALTER TABLE `done` ADD COLUMN `size` integer",
+             "ALTER TABLE `done` ADD COLUMN `partial_md5` text",
+             "CREATE INDEX IF NOT EXISTS `done_size` ON `done` (`size`, `partial_md5`)"]),
+        # The NSID of the photo's owner, where we know it, so that a
+        # full sync of one user doesn't remove anyone else's photos:
+        (4, ["ALTER TABLE `done` ADD COLUMN `owner` text"]),
+        # The API cache used to be kept here, but now has a file of
+        # its own (see ApiCache):
+        (5, ["DROP TABLE IF EXISTS `api_cache`"]),
+    ]
+
+    # Inside batch(), commit after this many writes by default:
+    BATCH_SIZE = 1000
+
     def __init__(self, db_filename):
         from sqlite3 import dbapi2 as sqlite
 
-        self.connection = sqlite.connect(db_filename)
-        self.cursor = self.connection.cursor()
+        self.connection = Timed(sqlite.connect(db_filename), 'sqlite')
+        self.cursor = Timed(self.connection.cursor(), 'sqlite')
+        # Write-ahead logging lets readers carry on while we write, and
+        # makes each commit much cheaper.
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.batch_size = None
+        self.n_uncommitted = 0
         self.cursor.execute("CREATE TABLE IF NOT EXISTS `done` "
                             "( `photo_id` text unique, "
                             "  `md5` text, "
                             "  `sha1` text )")
+        # A cache of the checksums of local files, so that unchanged
+        # files don't have to be read again.  A row is only valid as
+        # long as the size, modification time and inode of the file
+        # are the same as when the checksums were calculated.
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS `file_checksums` "
+                            "( `path` text primary key, "
+                            "  `size` integer, "
+                            "  `mtime_ns` integer, "
+                            "  `inode` integer, "
+                            "  `md5` text, "
+                            "  `sha1` text )")
+        self.migrate()
+
+    def migrate(self):
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        for to_version, statements in self.migrations:
+            if to_version <= version:
+                continue
+            for statement in statements:
+                self.cursor.execute(statement)
+            self.cursor.execute("PRAGMA user_version = %d" % to_version)
+            self.connection.commit()
+
+    # Within this context, writes are only committed every 'size' rows
+    # (and on leaving it), rather than after every row:
+    #
+    #   with db.batch():
+    #       for ...:
+    #           db.add_to_done(...)
+    @contextlib.contextmanager
+    def batch(self, size=None):
+        outer_batch_size = self.batch_size
+        self.batch_size = size or self.BATCH_SIZE
+        try:
+            yield self
+        finally:
+            self.batch_size = outer_batch_size
+            if self.batch_size is None:
+                self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.n_uncommitted = 0
 
-    def find(self, photo_id=None, md5=None, sha1=None):
+    # Called after every write, with the number of rows written:
+    def written(self, n_rows=1):
+        self.n_uncommitted += n_rows
+        if self.batch_size is None or self.n_uncommitted >= self.batch_size:
+            self.commit()
+
+    # With 'owner', only photos recorded as theirs are found:
+    def find(self, photo_id=None, md5=None, sha1=None, owner=None):
+        columns = "SELECT photo_id, md5, sha1, size, partial_md5 FROM done "
+        owned, owner_values = ("", ()) if owner is None else (" AND owner = ?", (owner,))
         if photo_id:
-            self.cursor.execute("SELECT * FROM done WHERE photo_id = ?", (photo_id,))
+            self.cursor.execute(columns + "WHERE photo_id = ?" + owned, (photo_id,) + owner_values)
         elif md5:
-            self.cursor.execute("SELECT * FROM done WHERE md5 = ?", (md5,))
+            self.cursor.execute(columns + "WHERE md5 = ?" + owned, (md5,) + owner_values)
         if sha1:
-            self.cursor.execute("SELECT * FROM done WHERE sha1 = ?", (sha1,))
-        return [dict(photo_id=i, md5=m, sha1=s) for i, m, s in self.cursor.fetchall()]
+            self.cursor.execute(columns + "WHERE sha1 = ?" + owned, (sha1,) + owner_values)
+        return [dict(photo_id=i, md5=m, sha1=s, size=n, partial_md5=p)
+                for i, m, s, n, p in self.cursor.fetchall()]
 
-    def add_to_done(self, photo_id, md5, sha1):
-        self.cursor.execute("INSERT INTO done VALUES ( ?, ?, ? )", (photo_id, md5, sha1,))
-        self.connection.commit()
+    def add_to_done(self, photo_id, md5, sha1, size=None, partial_md5=None):
+        self.cursor.execute("INSERT INTO done (photo_id, md5, sha1, size, partial_md5) "
+                            "VALUES ( ?, ?, ?, ?, ? )", (photo_id, md5, sha1, size, partial_md5))
+        self.done_changed()
+        self.written()
+
+    # Insert many (photo_id, md5, sha1, size, partial_md5) rows at once.
+    # Photos that are already there (with only an md5, say, from
+    # --sync) get the new checksums, and the size unless it's None:
+    def add_many_to_done(self, rows):
+        rows = list(rows)
+        self.cursor.executemany("INSERT INTO done (photo_id, md5, sha1, size, partial_md5) "
+                                "VALUES ( ?, ?, ?, ?, ? ) "
+                                "ON CONFLICT (photo_id) DO UPDATE SET "
+                                "  md5 = excluded.md5, "
+                                "  sha1 = excluded.sha1, "
+                                "  size = coalesce(excluded.size, size), "
+                                "  partial_md5 = coalesce(excluded.partial_md5, partial_md5)", rows)
+        self.done_changed()
+        self.written(len(rows))
     
+    # Insert or update many (photo_id, md5, sha1) rows at once, all
+    # owned by 'owner' if that's given.  A checksum (or owner) that is
+    # None doesn't overwrite one we already know.
+    def upsert_many_to_done(self, rows, owner=None):
+        rows = [tuple(row) + (owner,) for row in rows]
+        self.cursor.executemany("INSERT INTO done (photo_id, md5, sha1, owner) VALUES ( ?, ?, ?, ? ) "
+                                "ON CONFLICT (photo_id) DO UPDATE SET "
+                                "  md5 = coalesce(excluded.md5, md5), "
+                                "  sha1 = coalesce(excluded.sha1, sha1), "
+                                "  owner = coalesce(excluded.owner, owner)", rows)
+        self.done_changed()
+        self.written(len(rows))
+
+    def set_owner(self, photo_id, owner):
+        self.cursor.execute("UPDATE done SET owner = ? WHERE photo_id = ?", (owner, photo_id))
+        self.written()
+
+    def set_size(self, photo_id, size, partial_md5):
+        self.cursor.execute("UPDATE done SET size = ?, partial_md5 = ? WHERE photo_id = ?",
+                            (size, partial_md5, photo_id))
+        self.written()
+
+    # Whether any photo has this size (and partial_md5, if given):
+    def has_size(self, size, partial_md5=None):
+        if partial_md5 is None:
+            self.cursor.execute("SELECT 1 FROM done WHERE size = ? LIMIT 1", (size,))
+        else:
+            self.cursor.execute("SELECT 1 FROM done WHERE size = ? AND partial_md5 = ? LIMIT 1",
+                                (size, partial_md5))
+        return self.cursor.fetchone() is not None
+
+    # The number of photos whose size we don't know:
+    def count_without_size(self):
+        self.cursor.execute("SELECT count(*) FROM done WHERE size IS NULL")
+        return self.cursor.fetchone()[0]
+
     def remove_photo(self, photo_id):
         self.cursor.execute("DELETE FROM done WHERE photo_id = ?", (photo_id,))
-        self.connection.commit()
+        self.done_changed()
+        self.written()
+
+    # Yield each distinct 'column' ('md5' or 'sha1') of done, in order:
+    def digests(self, column='md5'):
+        if column not in ('md5', 'sha1'):
+            raise ValueError("Unknown digest column '{0}'".format(column))
+        cursor = self.connection.cursor()
+        for digest, in cursor.execute("SELECT DISTINCT {0} FROM done WHERE {0} IS NOT NULL "
+                                      "ORDER BY {0}".format(column)):
+            yield digest
+
+    # Yield (digest, [photo_id, ...]) for each 'column' ('md5' or
+    # 'sha1') shared by more than one photo, in order of digest, with
+    # the oldest photo first.  The grouping only needs the index on
+    # the column, so this is quick even for millions of photos.
+    def duplicates(self, column='md5'):
+        if column not in ('md5', 'sha1'):
+            raise ValueError("Unknown digest column '{0}'".format(column))
+        cursor = self.connection.cursor()
+        rows = cursor.execute("SELECT {0}, photo_id FROM done WHERE {0} IN "
+                              "( SELECT {0} FROM done WHERE {0} IS NOT NULL "
+                              "  GROUP BY {0} HAVING count(*) > 1 ) "
+                              "ORDER BY {0}, length(photo_id), photo_id".format(column))
+        for digest, group in itertools.groupby(rows, key=lambda row: row[0]):
+            yield digest, [photo_id for _, photo_id in group]
+
+    # Count a change to the checksums in done, for fingerprint().  The
+    # row count and largest rowid alone miss updates, such as sync
+    # filling in the md5 of a photo we already had.
+    def done_changed(self):
+        self.cursor.execute("INSERT INTO state VALUES ( 'done_version', 1 ) "
+                            "ON CONFLICT (name) DO UPDATE SET value = value + 1")
+
+    # The number of photos in done and how many times their checksums
+    # have changed, to tell whether an index built from it is out of
+    # date:
+    def fingerprint(self):
+        self.cursor.execute("SELECT count(*) FROM done")
+        count = self.cursor.fetchone()[0]
+        return (count, int(self.get_state('done_version', 0)))
+
+    # The photos other than those in 'photo_ids' that may be owned by
+    # 'owner': the ones recorded as theirs, and the ones whose owner we
+    # don't know.
+    def photos_except(self, photo_ids, owner):
+        self.cursor.execute("SELECT photo_id FROM done WHERE owner = ? OR owner IS NULL", (owner,))
+        return [i for i, in self.cursor.fetchall() if i not in photo_ids]
+
+    # Small named values that need to survive between runs, such as
+    # how far the last sync got:
+    def get_state(self, name, default=None):
+        self.cursor.execute("SELECT value FROM state WHERE name = ?", (name,))
+        row = self.cursor.fetchone()
+        return row[0] if row else default
+
+    def set_state(self, name, value):
+        self.cursor.execute("INSERT OR REPLACE INTO state VALUES ( ?, ? )", (name, value))
+        self.written()
+
+    def remove_state(self, name):
+        self.cursor.execute("DELETE FROM state WHERE name = ?", (name,))
+        self.written()
+
+    # Return the cached checksums of a local file, or None if there are
+    # none or the file has changed since they were calculated.
+    def cached_file_checksums(self, filename, key=None):
+        path = os.path.abspath(str(filename))
+        if key is None:
+            key = file_cache_key(path)
+        self.cursor.execute("SELECT size, mtime_ns, inode, md5, sha1 FROM file_checksums "
+                            "WHERE path = ?", (path,))
+        row = self.cursor.fetchone()
+        if row and tuple(row[0:3]) == tuple(key):
+            metrics.count('checksum_cache_hits')
+            return dict(md5=row[3], sha1=row[4])
+        metrics.count('checksum_cache_misses')
+        return None
+
+    # 'key' should be the file_cache_key() of the file from *before*
+    # its checksums were calculated.
+    def add_file_checksums(self, filename, key, checksums):
+        path = os.path.abspath(str(filename))
+        self.cursor.execute("INSERT OR REPLACE INTO file_checksums VALUES ( ?, ?, ?, ?, ?, ? )",
+                            (path,) + tuple(key) + (checksums['md5'], checksums['sha1']))
+        self.written()
+
+    # Return the checksums of a local file, from the cache if the file
+    # hasn't changed since they were calculated, otherwise by reading
+    # the file (and updating the cache).
+    def file_checksums(self, filename):
+        key = file_cache_key(filename)
+        checksums = self.cached_file_checksums(filename, key)
+        if checksums is None:
+            checksums = file_checksums(filename)
+            self.add_file_checksums(filename, key, checksums)
+        return checksums
+
+    # Remove cached checksums for files that no longer exist.  Returns
+    # the number of rows removed.
+    def prune_file_checksums(self):
+        self.cursor.execute("SELECT path FROM file_checksums")
+        missing = [(path,) for path, in self.cursor.fetchall() if not os.path.exists(path)]
+        self.cursor.executemany("DELETE FROM file_checksums WHERE path = ?", missing)
+        self.written(len(missing))
+        return len(missing)
+
+
+# Whether the API method 'name' (such as 'photos_search') can safely
+# be made again if it fails part way: everything that only reads, and
+# adding tags or setting dates, which come out the same however many
+# times they are done.  Uploads are left to the caller (see
+# flickr-upload.py), and authentication isn't retried.
+idempotent_prefixes = ('get', 'search', 'find', 'lookup', 'recently', 'login',
+                       'addTags', 'setDates')
+
+def idempotent(name):
+    method = name.split('_', 1)[-1]
+    return '_' in name and method.startswith(idempotent_prefixes)
+
+
+# A FlickrAPI object that is only created, and authenticated, when it
+# is first used.  Importing flickrapi and authenticating are slow and
+# need the API key, so commands that can be answered from the local
+# database shouldn't pay for them.
+class LazyFlickr:
+    def __init__(self, perms='write'):
+        self.perms = perms
+        self.flickr = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        with self.lock:
+            if self.flickr is None:
+                import flickrapi
+                configuration = get_configuration()
+                flickr = Timed(flickrapi.FlickrAPI(configuration['api_key'], configuration['api_secret']),
+                               'api', per_method=True)
+                # Retries take from the rate limit like any other call:
+                flickr = Retried(flickr, 'api', idempotent, before_retry=throttler.register)
+                throttler.share_state(rate_limit_db_filename)
+                throttler.register()
+                flickr.authenticate_via_browser(perms=self.perms)
+                self.flickr = flickr
+        return self.flickr
+
+    def __getattr__(self, name):
+        return getattr(self.flickr or self.connect(), name)
+
+
+# A cache of the answers to Flickr API calls that rarely change, kept
+# in a small SQLite database so that it lasts between runs.  Each
+# method has its own time to live, and when there are more than
+# 'max_entries' answers the least recently used ones are thrown away.
+# Like the Throttler, it has a connection of its own, which can be
+# used from any thread, to a file of its own, so that it isn't locked
+# out while a batch of writes to the checksum database is open.  Since
+# it's only a cache, anything that goes wrong with it is ignored.
+class ApiCache:
+    DAY = 24 * 3600
+
+    ttls = {
+        'people_findByUsername': 30 * DAY,
+        'urls_lookupUser': 30 * DAY,
+        'people_getInfo': DAY,
+        'photos_getInfo': DAY,
+    }
+
+    MAX_ENTRIES = 10000
+
+    def __init__(self, db_filename, max_entries=MAX_ENTRIES):
+        import sqlite3
+        self.max_entries = max_entries
+        self.n_puts = 0
+        self.lock = threading.Lock()
+        self.connection = None
+        try:
+            connection = sqlite3.connect(db_filename, isolation_level=None,
+                                         check_same_thread=False, timeout=1)
+            connection.execute("CREATE TABLE IF NOT EXISTS `api_cache` "
+                               "( `key` text primary key, "
+                               "  `value` blob, "
+                               "  `expires` real, "
+                               "  `used` real )")
+            connection.execute("CREATE INDEX IF NOT EXISTS `api_cache_used` "
+                               "ON `api_cache` (`used`)")
+            self.connection = connection
+        except sqlite3.Error:
+            pass
+
+    def get(self, key):
+        import sqlite3
+        if self.connection is None:
+            return None
+        with self.lock:
+            try:
+                row = self.connection.execute("SELECT value, expires FROM api_cache WHERE key = ?",
+                                              (key,)).fetchone()
+                if row is None or row[1] < time.time():
+                    return None
+                self.connection.execute("UPDATE api_cache SET used = ? WHERE key = ?",
+                                        (time.time(), key))
+            except sqlite3.Error:
+                return None
+            return row[0]
+
+    def put(self, key, value, ttl):
+        import sqlite3
+        if self.connection is None:
+            return
+        with self.lock:
+            try:
+                self.connection.execute("INSERT OR REPLACE INTO api_cache VALUES ( ?, ?, ?, ? )",
+                                        (key, value, time.time() + ttl, time.time()))
+                # Trim the cache now and then, rather than on every put:
+                self.n_puts += 1
+                if self.n_puts % 100 == 1:
+                    self.connection.execute("DELETE FROM api_cache WHERE key IN "
+                                            "( SELECT key FROM api_cache ORDER BY used DESC "
+                                            "  LIMIT -1 OFFSET ? )", (self.max_entries,))
+            except sqlite3.Error:
+                pass
+
+
+# Wraps a (Lazy)FlickrAPI object so that the methods in ApiCache.ttls
+# are answered from 'cache' where possible.  Those methods take a
+# token from the throttler themselves, and only when they really call
+# Flickr, so callers mustn't.  With 'cache' None nothing is cached.
+class CachedFlickr:
+    def __init__(self, flickr, cache):
+        self.flickr = flickr
+        self.cache = cache
+
+    def __getattr__(self, name):
+        if name not in ApiCache.ttls:
+            return getattr(self.flickr, name)
+
+        def cached(**kwargs):
+            try:
+                from lxml import etree
+            except ImportError:
+                import xml.etree.ElementTree as etree
+            key = name + '?' + '&'.join('{0}={1}'.format(k, v) for k, v in sorted(kwargs.items()))
+            if self.cache is not None:
+                value = self.cache.get(key)
+                if value is not None:
+                    metrics.count('api_cache_hits')
+                    return etree.fromstring(value)
+                metrics.count('api_cache_misses')
+            throttler.register()
+            result = getattr(self.flickr, name)(**kwargs)
+            if self.cache is not None:
+                self.cache.put(key, etree.tostring(result), ApiCache.ttls[name])
+            return result
+        return cached
+
+
+# Add the options for cached_flickr() to an ArgumentParser:
+def add_api_cache_arguments(parser):
+    parser.add_argument('--no-api-cache', dest='no_api_cache', default=False, action='store_true',
+                        help="don't use or update the cache of Flickr user and photo details")
+    parser.add_argument('--api-cache-size', dest='api_cache_size', type=int,
+                        default=ApiCache.MAX_ENTRIES, metavar='N',
+                        help='keep at most N answers in the cache of Flickr user and photo '
+                             'details (default: {0})'.format(ApiCache.MAX_ENTRIES))
+
+# Return 'flickr' wrapped in a CachedFlickr, according to the options
+# added by add_api_cache_arguments():
+def cached_flickr(flickr, args):
+    if args.no_api_cache:
+        return CachedFlickr(flickr, None)
+    return CachedFlickr(flickr, ApiCache(api_cache_db_filename, args.api_cache_size))
 
 
 # Return the Flickr NSID for a username or alias:
 def get_nsid(username_or_alias, flickr):
+    from flickrapi.exceptions import FlickrError
+
     try:
         # If someone provides their real username (i.e. [USERNAME] in
         # "About [USERNAME]" on their profile page, then this call
         # should work:
-        throttler.register()
         user = flickr.people_findByUsername(username=username_or_alias)
-    except flickrapi.exceptions.FlickrError:
+    except FlickrError:
         # However, people who've set an alias for their Flickr URLs
         # sometimes think their username is that alias, so try that
         # afterwards.  (That's [ALIAS] in
         # http://www.flickr.com/photos/[ALIAS], for example.)
         try:
-            throttler.register()
             username = flickr.urls_lookupUser(url="http://www.flickr.com/people/"+username_or_alias)
             user_id = username.getchildren()[0].getchildren()[0].text
-            throttler.register()
             user = flickr.people_findByUsername(username=user_id)
-        except flickrapi.exceptions.FlickrError:
+        except FlickrError:
             return None
     return user.getchildren()[0].attrib['nsid']
 
 # Return a dictionary with any machine tag checksums found for a photo
 # element:
-def get_photo_checksums(photo):
+def get_photo_checksums(photo, verbose=True):
     md5_match = re.compile(md5_machine_tag_prefix + r'([0-9a-f]{32})')
     sha1_match = re.compile(sha1_machine_tag_prefix + r'([0-9a-f]{40})')
 
@@ -134,17 +622,23 @@ def get_photo_checksums(photo):
     for t in tags:
         m_md5 = md5_match.search(t)
         if m_md5 and len(m_md5.group(1)) == 32:
-            print("Got MD5sum machine tag")
+            if verbose:
+                print("Got MD5sum machine tag")
             result['md5'] = m_md5.group(1)
         m_sha1 = sha1_match.search(t)
         if m_sha1 and len(m_sha1.group(1)) == 40:
-            print("Got SHA1sum machine tag")
+            if verbose:
+                print("Got SHA1sum machine tag")
             result['sha1'] = m_sha1.group(1)
 
     return result
 
 def info_to_url(photo_info,size=""):
-    a = photo_info.getchildren()[0].attrib
+    return photo_url(photo_info.getchildren()[0].attrib, size)
+
+# The URL of a size of a photo, from the attributes of a <photo> (from
+# photos_getInfo, or photos_search with extras='original_format'):
+def photo_url(a, size=""):
     if size in ( "", "-" ):
         return 'http://farm%s.static.flickr.com/%s/%s_%s.jpg' %  (a['farm'], a['server'], a['id'], a['secret'])
     elif size in ( "s", "t", "m", "b" ):
@@ -156,8 +650,9 @@ def info_to_url(photo_info,size=""):
 
 
 def add_checksum(options, flickr):
-    db_filename = os.path.join(os.environ['HOME'],'.flickr-photos-checksummed.db')
-    db = SqliteDb(db_filename)
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    db = SqliteDb(checksum_db_filename)
 
     nsid = get_nsid(options.add_tags, flickr)
     if not nsid:
@@ -165,75 +660,298 @@ def add_checksum(options, flickr):
 
     print("Got nsid: %s for '%s'" % ( nsid, options.add_tags ))
 
-    throttler.register()
     user_info = flickr.people_getInfo(user_id=nsid)
     photos_url = user_info.getchildren()[0].find('photosurl').text
 
+    # Originals are downloaded and hashed by 'workers' threads, and the
+    # next page is fetched in the background, while tagging and all
+    # database writes are done from this thread.
+    workers = options.workers
+    pool = farm_pool(maxsize=workers)
+    # Fewer downloads run at once while the farm servers are struggling:
+    limit = AdaptiveLimit(workers)
+
+    # After each page, the page number is saved, so that if the run is
+    # interrupted the next one can carry on from the page after it.
+    # Sorting oldest first means new uploads don't move photos between
+    # pages in the meantime.
     per_page = 500
-    page = 1
+    sort = 'date-posted-asc'
+    checkpoint_name = 'add_checksum_checkpoint:' + nsid
+    first_page = 1
+    checkpoint = db.get_state(checkpoint_name)
+    if checkpoint and not options.restart:
+        last_page, last_per_page, last_sort = checkpoint.split()
+        if int(last_per_page) == per_page and last_sort == sort:
+            first_page = int(last_page) + 1
+            print("Resuming after page {0}".format(last_page))
+
+    pages = prefetched(search_pages(flickr.photos_search, per_page=per_page, first_page=first_page,
+                                    user_id=nsid, sort=sort, media='photo',
+                                    extras='machine_tags,url_o'))
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as downloader:
+        for page, photo_elements in enumerate(pages, first_page):
+            n_flickr_requests_last_photo = throttler.n_requests
+            print("----------------------------------------------------------------")
+            # The rows for this page are written in one go at the end of
+            # the page (or if something goes wrong half way through it):
+            done_rows = []
+            downloads = {}
+            try:
+                for photo in photo_elements:
+                    metrics.count('photos')
+                    progress("Flickr API requests: {0} ({1} in {2} s)".format(
+                        throttler.n_requests - n_flickr_requests_last_photo, throttler.n_requests,
+                        int(time.time() - throttler.start)))
+                    n_flickr_requests_last_photo = throttler.n_requests
+                    title = photo.attrib['title']
+                    progress("===== {0} (page {1}) =====".format(title, page))
+                    # Photos that --sync found with only one checksum
+                    # still need the other:
+                    known = db.find(photo_id=photo.attrib['id'])
+                    if known and known[0]['md5'] and known[0]['sha1']:
+                        continue
+                    progress("Photo page URL is: "+photos_url+photo.attrib['id'])
+
+                    # We got the info we need in the search request directly.
+                    #throttler.register()
+                    #photo_info = flickr.photos_getInfo(photo_id=photo.attrib['id']).getchildren()[0]
+
+                    # Check if the checksums are already there:
+                    checksums = get_photo_checksums(photo, verbose=show_progress)
+                    progress("Existing checksums were: "+", ".join(list(checksums.keys())))
+                    if ('md5' in checksums) and ('sha1' in checksums):
+                        # Then there's no need to download the image...
+                        done_rows.append((photo.attrib['id'], checksums['md5'], checksums['sha1'],
+                                          None, None))
+                    else:
+                        # Otherwise fetch the original image and
+                        # calculate its checksums...
+                        downloads[downloader.submit(fetch_checksums, photo, pool, limit)] = photo
 
+                # ... and set those tags as the downloads finish.  A photo
+                # that still fails after being retried is skipped, and
+                # left for the next run:
+                for future in as_completed(downloads):
+                    photo = downloads[future]
+                    try:
+                        checksums = future.result()
+                        tag_photo(photo, flickr, checksums)
+                    except Exception as e:
+                        print("Failed to add checksums to photo {0}: {1}".format(
+                            photo.attrib['id'], e), file=sys.stderr)
+                        metrics.count('failures')
+                        failed += 1
+                        continue
+                    done_rows.append((photo.attrib['id'], checksums['md5'], checksums['sha1'],
+                                      checksums['size'], checksums['partial']))
+            finally:
+                for future in downloads:
+                    future.cancel()
+                db.add_many_to_done(done_rows)
+            # Once a photo has failed, the checkpoint stays before it,
+            # so that the next run goes back for it:
+            if not failed:
+                db.set_state(checkpoint_name, "{0} {1} {2}".format(page, per_page, sort))
+
+    if failed:
+        print("{0} photos failed; run again to retry them".format(failed), file=sys.stderr)
+        sys.exit(1)
+    # We got to the end, so the next run should start from the beginning:
+    db.remove_state(checkpoint_name)
+
+
+# Iterate over 'iterable', fetching the next item in a background
+# thread while the current one is being processed:
+def prefetched(iterable):
+    from concurrent.futures import ThreadPoolExecutor
+
+    iterator = iter(iterable)
+    end = object()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, iterator, end)
+        while True:
+            item = future.result()
+            if item is end:
+                return
+            future = executor.submit(next, iterator, end)
+            yield item
+
+
+# Yield the photo elements of each page of a paged API method, such
+# as photos_search, until a page comes back short:
+def search_pages(method, per_page=500, first_page=1, **kwargs):
+    page = first_page
     while True:
-        print("Getting page {0} (photos {1} to {2})".format(page, (page - 1) * per_page + 1, page * per_page))
+        progress("Getting page {0} (photos {1} to {2})".format(page, (page - 1) * per_page + 1, page * per_page))
         throttler.register()
-        photos = flickr.photos_search(user_id=nsid, per_page=str(per_page), page=page, media='photo', extras='machine_tags,url_o')
+        photos = method(per_page=str(per_page), page=page, **kwargs)
         photo_elements = photos.getchildren()[0]
-        n_flickr_requests_last_photo = throttler.n_requests
-        print("----------------------------------------------------------------")
-        for photo in photo_elements:
-            print("Flickr API requests: {0} ({1} in {2} s)".format(
-                throttler.n_requests - n_flickr_requests_last_photo, throttler.n_requests,
-                int(time.time() - throttler.start)))
-            n_flickr_requests_last_photo = throttler.n_requests
-            title = photo.attrib['title']
-            print("===== {0} (page {1}) =====".format(title, page))
-            if db.find(photo_id=photo.attrib['id']):
-                continue
-            print("Photo page URL is: "+photos_url+photo.attrib['id'])
-            
-            # We got the info we need in the search request directly.
-            #throttler.register()
-            #photo_info = flickr.photos_getInfo(photo_id=photo.attrib['id']).getchildren()[0]
-
-            # Check if the checksums are already there:
-            checksums = get_photo_checksums(photo)
-            print("Existing checksums were: "+", ".join(list(checksums.keys())))
-            if ('md5' in checksums) and ('sha1' in checksums):
-                # Then there's no need to download the image...
-                pass
-            else:
-                # Otherwise fetch the original image,
-                # calculate its checksums and set those tags:
-                checksums = fetch_and_tag(photo, flickr)
-            db.add_to_done(photo.attrib['id'], checksums['md5'], checksums['sha1'])
+        yield photo_elements
         if len(photo_elements) < per_page:
             break
         page += 1
 
 
-def fetch_and_tag(photo, flickr):
+# Copy the checksum machine tags of a user's photos into the local
+# database, 500 photos per API call, so that lookups can be done
+# offline afterwards.
+#
+# The last update time of the newest photo seen is remembered, and the
+# next sync then only asks for photos updated since.  That's done with
+# photos_recentlyUpdated, which only works for the authenticated
+# user's own photos.  With --full every photo is fetched again, oldest
+# first so that new uploads don't move photos between pages, and the
+# authenticated user's photos that are no longer on Flickr are removed
+# from the database.
+def sync_checksums(options, flickr):
+    db = SqliteDb(checksum_db_filename)
+
+    nsid = get_nsid(options.sync, flickr)
+    if not nsid:
+        print("Couldn't find the username or alias '"+options.sync)
+        sys.exit(1)
+
+    throttler.register()
+    own_photos = flickr.test_login().getchildren()[0].attrib['id'] == nsid
+
+    watermark_name = 'sync_watermark:' + nsid
+    watermark = db.get_state(watermark_name)
+    if watermark and not options.full and not own_photos:
+        print("Only your own photos can be synced incrementally; doing a full sync")
+        watermark = None
+    if options.full and not own_photos:
+        print("Only your own photos are removed when they're no longer on Flickr")
+
+    extras = 'machine_tags,last_update'
+    latest_update = int(watermark or 0)
+    n_photos = 0
+    n_with_checksums = 0
+
+    with db.batch():
+        if watermark and not options.full:
+            print("Getting photos updated since {0}".format(time.ctime(int(watermark))))
+            photos, complete = recently_updated(flickr, watermark, extras)
+            pages = [list(photos.values())]
+            if not complete:
+                print("Photos kept changing during the sync; the next one will look at them again")
+            seen_photo_ids = None
+        else:
+            pages = search_pages(flickr.photos_search, user_id=nsid, sort='date-posted-asc',
+                                 extras=extras)
+            complete = True
+            seen_photo_ids = set()
+
+        for photo_elements in pages:
+            rows = []
+            for photo in photo_elements:
+                checksums = get_photo_checksums(photo, verbose=False)
+                if checksums:
+                    rows.append((photo.attrib['id'], checksums.get('md5'), checksums.get('sha1')))
+                latest_update = max(latest_update, int(photo.attrib.get('lastupdate', 0)))
+                if seen_photo_ids is not None:
+                    seen_photo_ids.add(photo.attrib['id'])
+            db.upsert_many_to_done(rows, owner=nsid)
+            n_photos += len(photo_elements)
+            n_with_checksums += len(rows)
+
+        print("Synced {0} photos, {1} with checksum tags".format(n_photos, n_with_checksums))
+        if options.full and own_photos:
+            removed = remove_deleted_photos(db, flickr, nsid, seen_photo_ids)
+            print("Removed {0} photos that are no longer on Flickr".format(removed))
+        if complete:
+            db.set_state(watermark_name, str(latest_update))
+
+    # Rebuild the filter that find_not_uploaded.py --bloom uses:
+    from digest_index import md5_bloom_filter
+    md5_bloom_filter(db, checksum_bloom_filename, rebuild=True)
+
+
+# The photos updated since 'min_date', as a dictionary from photo ID
+# to photo element.  When that takes more than one page, a photo that
+# is updated in the meantime moves between pages and can make us miss
+# another, so the pages are then read again until two readings agree.
+# Returns the photos and whether they ever did.
+def recently_updated(flickr, min_date, extras, max_readings=3):
+    def versions(photos):
+        return dict((photo_id, photo.attrib.get('lastupdate')) for photo_id, photo in photos.items())
+
+    photos = {}
+    previous = None
+    for reading in range(max_readings):
+        current = {}
+        n_pages = 0
+        for photo_elements in search_pages(flickr.photos_recentlyUpdated, min_date=min_date,
+                                           extras=extras):
+            n_pages += 1
+            for photo in photo_elements:
+                current[photo.attrib['id']] = photo
+        photos.update(current)
+        if n_pages == 1 or versions(current) == previous:
+            return photos, True
+        previous = versions(current)
+    return photos, False
+
+
+# Remove the photos that may be 'nsid''s (see SqliteDb.photos_except),
+# other than those in 'seen_photo_ids', from the database.  Each one is
+# looked up first, and only removed if Flickr says it's gone: a photo
+# that was missed because the pages changed during the sync, or that
+# turns out to be someone else's, is kept.  Returns how many were
+# removed.
+def remove_deleted_photos(db, flickr, nsid, seen_photo_ids):
+    from flickrapi.exceptions import FlickrError
+
+    # Flickr's error code for "Photo not found":
+    photo_not_found = 1
+
+    removed = 0
+    for photo_id in db.photos_except(seen_photo_ids, nsid):
+        try:
+            photo_info = flickr.photos_getInfo(photo_id=photo_id)
+        except FlickrError as e:
+            if e.code != photo_not_found:
+                raise
+            db.remove_photo(photo_id)
+            removed += 1
+        else:
+            db.set_owner(photo_id, photo_info.getchildren()[0].find('owner').attrib['nsid'])
+    return removed
+
+
+# 'pool' should be a connection pool from common.farm_pool(), shared
+# between calls so that each photo doesn't need a new connection.
+def fetch_checksums(photo, pool, limit=None):
     farm_url = photo.attrib['url_o']
-    print("farm_url is: "+farm_url)
+    progress("farm_url is: "+farm_url)
 
-    import certifi
-    import urllib3
-    pool = urllib3.PoolManager(cert_reqs='CERT_REQUIRED',
-                               ca_certs=certifi.where())
-    response = pool.request('GET', farm_url)
+    # The partial checksum and size come for free on the way past, and
+    # let find_not_uploaded.py --quick rule out other files cheaply.
+    checksums = call_with_retries(
+        'farm', lambda: url_checksums(pool, farm_url, checksum_algorithms + ('partial',)),
+        limit=limit)
+    progress("Calculated MD5: "+checksums['md5'])
+    progress("Calculated SHA1: "+checksums['sha1'])
+    return checksums
 
-    import hashlib
-    real_md5sum = hashlib.md5(response.data).hexdigest()
-    real_sha1sum = hashlib.sha1(response.data).hexdigest()
-    print("Calculated MD5: "+real_md5sum)
-    print("Calculated SHA1: "+real_sha1sum)
 
-    print("Setting tags...")
+def tag_photo(photo, flickr, checksums):
+    progress("Setting tags...")
     throttler.register()
     flickr.photos_addTags(photo_id=photo.attrib['id'],
-        tags=" ".join([md5_machine_tag_prefix + real_md5sum,
-                       sha1_machine_tag_prefix + real_sha1sum]))
-    print("... done.")
+        tags=" ".join([md5_machine_tag_prefix + checksums['md5'],
+                       sha1_machine_tag_prefix + checksums['sha1']]))
+    progress("... done.")
+
 
-    return dict(md5=real_md5sum, sha1=real_sha1sum)
+def fetch_and_tag(photo, flickr, pool=None):
+    if pool is None:
+        pool = farm_pool()
+    checksums = fetch_checksums(photo, pool)
+    tag_photo(photo, flickr, checksums)
+    return dict(md5=checksums['md5'], sha1=checksums['sha1'])
 
 
 class MalformedChecksum(Exception):
@@ -279,6 +997,165 @@ def get_photo_by_checksum(flickr, md5='', sha1=''):
     return photo_elements[0]
 
 
+# How many checksums to look for in one photos_search:
+checksums_per_search = 20
+
+# Look up many checksums (MD5s or SHA1s, one per line) read from
+# options.batch ('-' for standard input), and print a line for each,
+# in the same order:
+#
+#   CHECKSUM PHOTO_ID PAGE_URL [SIZE_URL] SHORT_URL
+#
+# or "CHECKSUM not-found", "CHECKSUM multiple PHOTO_ID,PHOTO_ID..." or
+# "CHECKSUM malformed".  The local database answers what it can from
+# the logged-in user's photos (the others may not be theirs, or may be
+# gone), and the rest are looked for among their photos on Flickr
+# checksums_per_search at a time (with tag_mode=any).  The database doesn't know what a SIZE_URL
+# needs, so with --size everything is looked for on Flickr.  Photos
+# found on Flickr are added to the database.
+def lookup_checksums(options, flickr):
+    db = SqliteDb(checksum_db_filename)
+
+    checksums = []
+    lines = sys.stdin if options.batch == '-' else open(options.batch)
+    for line in lines:
+        checksum = line.strip().lower()
+        if checksum:
+            checksums.append(checksum)
+
+    def kind(checksum):
+        return 'md5' if len(checksum) == 32 else 'sha1'
+
+    def well_formed(checksum):
+        return len(checksum) in (32, 40) and re.match('^' + checksum_pattern + '$', checksum)
+
+    throttler.register()
+    nsid = flickr.test_login().getchildren()[0].attrib['id']
+
+    photo_ids = {}
+    wanted = []
+    seen = set()
+    for checksum in checksums:
+        if checksum in seen or not well_formed(checksum):
+            continue
+        seen.add(checksum)
+        rows = [] if options.size else db.find(owner=nsid, **{kind(checksum): checksum})
+        if rows:
+            photo_ids[checksum] = [row['photo_id'] for row in rows]
+        else:
+            wanted.append(checksum)
+
+    prefixes = dict(md5=md5_machine_tag_prefix, sha1=sha1_machine_tag_prefix)
+    photos = {}
+    for i in range(0, len(wanted), checksums_per_search):
+        group = set(wanted[i:i + checksums_per_search])
+        tags = ",".join(prefixes[kind(checksum)] + checksum for checksum in sorted(group))
+        rows = []
+        for photo_elements in search_pages(flickr.photos_search, user_id='me', tags=tags,
+                                           tag_mode='any', extras='machine_tags,original_format'):
+            for photo in photo_elements:
+                photo_id = photo.attrib['id']
+                photos[photo_id] = photo
+                found = get_photo_checksums(photo, verbose=False)
+                for checksum in found.values():
+                    if checksum in group and photo_id not in photo_ids.get(checksum, []):
+                        photo_ids.setdefault(checksum, []).append(photo_id)
+                if found:
+                    rows.append((photo_id, found.get('md5'), found.get('sha1')))
+        db.upsert_many_to_done(rows, owner=nsid)
+
+    # The page URLs all start with the owner's photosurl, so it only
+    # needs asking for once:
+    photos_url = None
+    if photo_ids:
+        photos_url = flickr.people_getInfo(user_id=nsid).getchildren()[0].find('photosurl').text
+
+    for checksum in checksums:
+        if not well_formed(checksum):
+            print(checksum + " malformed")
+        elif checksum not in photo_ids:
+            print(checksum + " not-found")
+        elif len(photo_ids[checksum]) > 1:
+            print(checksum + " multiple " + ",".join(photo_ids[checksum]))
+        else:
+            photo_id = photo_ids[checksum][0]
+            fields = [checksum, photo_id, photos_url + photo_id]
+            if options.size:
+                fields.append(photo_url(photos[photo_id].attrib, options.size))
+            fields.append(short_url(photo_id))
+            print(" ".join(fields))
+
+
+# Print the photos in the local database that share a checksum, one
+# group per line (or, with options.duplicates_format "csv", one photo
+# per row, or a JSON list of groups), without asking Flickr.  Run
+# --sync first to make sure the database is up to date.
+def report_duplicates(options):
+    import csv
+    import json
+
+    db = SqliteDb(checksum_db_filename)
+    column = options.duplicates
+    writer = csv.writer(sys.stdout)
+    if options.duplicates_format == 'csv':
+        writer.writerow([column, 'photo_id', 'short_url', 'copies'])
+    elif options.duplicates_format == 'json':
+        sys.stdout.write("[")
+
+    n_groups = n_extra_copies = 0
+    for digest, photo_ids in db.duplicates(column):
+        if options.duplicates_format == 'csv':
+            for photo_id in photo_ids:
+                writer.writerow([digest, photo_id, short_url(photo_id), len(photo_ids)])
+        elif options.duplicates_format == 'json':
+            group = {column: digest,
+                     'photos': [dict(id=photo_id, short_url=short_url(photo_id))
+                                for photo_id in photo_ids]}
+            sys.stdout.write((",\n " if n_groups else "\n ") + json.dumps(group, sort_keys=True))
+        else:
+            print(digest + " " + " ".join("{0} {1}".format(photo_id, short_url(photo_id))
+                                          for photo_id in photo_ids))
+        n_groups += 1
+        n_extra_copies += len(photo_ids) - 1
+
+    if options.duplicates_format == 'json':
+        sys.stdout.write("\n]\n")
+    sys.stdout.flush()
+    print("{0} photos have duplicates ({1} extra copies)".format(n_groups, n_extra_copies),
+          file=sys.stderr)
+
+
+# Write a snapshot of the local database to options.export_snapshot,
+# or merge the one in options.import_snapshot into it (see
+# digest_index.Snapshot).  Checksums already in the database are kept
+# where the snapshot doesn't have them.
+def transfer_snapshot(options):
+    from digest_index import Snapshot
+
+    db = SqliteDb(checksum_db_filename)
+    if options.export_snapshot:
+        n_photos = Snapshot.write(db, options.export_snapshot)
+        print("Wrote {0} photos to {1}".format(n_photos, options.export_snapshot))
+        return
+
+    try:
+        snapshot = Snapshot.load(options.import_snapshot)
+    except (IOError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    n_before = db.fingerprint()[0]
+    records = snapshot.records()
+    # Committing less often than usual makes a big import much quicker:
+    with db.batch(100 * db.BATCH_SIZE):
+        while True:
+            rows = list(itertools.islice(records, db.BATCH_SIZE))
+            if not rows:
+                break
+            db.upsert_many_to_done(rows)
+    print("Merged {0} photos from {1} ({2} new)".format(
+        len(snapshot), options.import_snapshot, db.fingerprint()[0] - n_before))
+
+
 def main():
     from argparse import ArgumentParser
 
@@ -286,28 +1163,83 @@ def main():
     parser.add_argument('-a', '--add-tags', dest='add_tags',
                     metavar='USERNAME',
                     help='add checksum machine tags for [USERNAME]\'s photos')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                    metavar='N',
+                    help='with -a, download and checksum N photos at a time')
+    parser.add_argument('--restart', dest='restart', default=False, action='store_true',
+                    help='with -a, start from the first page rather than where the last run stopped')
     parser.add_argument('-m', dest='md5',
                     metavar='MD5SUM',
                     help='find my photo on Flickr with MD5sum [MD5SUM]')
     parser.add_argument('-s', dest='sha1',
                     metavar='SHA1SUM',
                     help='find my photo on Flickr with SHA1sum [SHA1SUM]')
+    parser.add_argument('-b', '--batch', dest='batch',
+                    metavar='FILENAME',
+                    help='find my photos with the MD5sums or SHA1sums in FILENAME (one per '
+                         'line, - for standard input), printing the id and URLs of each')
     parser.add_argument('-p', dest='photo_page', default=False, action='store_true',
                     help='Output the photo page URL (the default with -m and -s)')
     parser.add_argument('--size',dest='size',metavar='SIZE',
                     help='Output the URL for different sized images ('+valid_size_codes_sentence+')')
     parser.add_argument('--short',dest='short', default=False, action='store_true',
                     help='Output the short URL for the image')
+    parser.add_argument('--sync', dest='sync',
+                    metavar='USERNAME',
+                    help='copy the checksum machine tags of all [USERNAME]\'s photos to the local database')
+    parser.add_argument('--full', dest='full', default=False, action='store_true',
+                    help='with --sync, fetch all photos rather than only those updated since the last sync, '
+                         'and remove your photos that are no longer on Flickr')
+    parser.add_argument('-q', '--quiet', dest='quiet', default=False, action='store_true',
+                    help='don\'t print progress for every photo')
+    parser.add_argument('--duplicates', dest='duplicates', nargs='?', const='md5',
+                    choices=['md5', 'sha1'],
+                    help='list the photos in the local database that have the same MD5sum '
+                         '(or SHA1sum), without asking Flickr')
+    parser.add_argument('--duplicates-format', dest='duplicates_format', default='text',
+                    choices=['text', 'csv', 'json'],
+                    help='with --duplicates, print one line per group (text, the default), '
+                         'one CSV row per photo, or a JSON list of groups')
+    parser.add_argument('--export-snapshot', dest='export_snapshot', metavar='FILENAME',
+                    help='write the checksums in the local database to FILENAME, for '
+                         '--import-snapshot on another machine')
+    parser.add_argument('--import-snapshot', dest='import_snapshot', metavar='FILENAME',
+                    help='add the checksums in FILENAME (from --export-snapshot) to the '
+                         'local database')
+    add_metrics_arguments(parser)
+    add_api_cache_arguments(parser)
+    parser.add_argument('--prune-cache', dest='prune_cache', default=False, action='store_true',
+                    help='Remove cached checksums of local files that no longer exist')
 
     options = parser.parse_args()
 
-    mutually_exclusive_options = [ options.add_tags, options.md5, options.sha1 ]
+    global show_progress
+    show_progress = not options.quiet
+    start_metrics(options)
+
+    mutually_exclusive_options = [ options.add_tags, options.md5, options.sha1, options.batch,
+                                   options.sync, options.prune_cache, options.duplicates,
+                                   options.export_snapshot, options.import_snapshot ]
 
     if 1 != len([x for x in mutually_exclusive_options if x]):
-        print("You must specify exactly one of '-a', '-m' or 's':")
+        print("You must specify exactly one of '-a', '-m', '-s', '-b', '--sync', "
+              "'--prune-cache', '--duplicates', '--export-snapshot' or '--import-snapshot':")
         parser.print_help()
         sys.exit(1)
 
+    if options.prune_cache:
+        db = SqliteDb(checksum_db_filename)
+        print("Removed {0} cached checksums".format(db.prune_file_checksums()))
+        return
+
+    if options.duplicates:
+        report_duplicates(options)
+        return
+
+    if options.export_snapshot or options.import_snapshot:
+        transfer_snapshot(options)
+        return
+
     if options.photo_page and options.size:
         print("options.photo_page is "+str(options.photo_page))
         print("You can specify at most one of -p and --size")
@@ -317,25 +1249,27 @@ def main():
     if options.size and (options.size not in valid_size_codes):
         print("The argument to --size must be one of: "+valid_size_codes_sentence)
 
-    flickr = flickrapi.FlickrAPI(configuration['api_key'],configuration['api_secret'])
-    throttler.register()
-    flickr.authenticate_via_browser(perms='write')
+    flickr = cached_flickr(LazyFlickr(perms='write'), options)
 
     if options.md5 or options.sha1:
         photo = get_photo_by_checksum(flickr, md5=options.md5, sha1=options.sha1)
         photo_id = photo.attrib['id']
-        throttler.register()
         photo_info = flickr.photos_getInfo(photo_id=photo_id).getchildren()[0]
 
         just_photo_page_url = not (options.size or options.short)
         if just_photo_page_url:
-            throttler.register()
             user_info = flickr.people_getInfo(user_id=photo.attrib['owner']).getchildren()[0]
             print(user_info.find('photosurl').text+photo_id)
         elif options.size:
-            print(info_to_url(photo_info,size=options.size))
+            print(photo_url(photo_info.attrib, size=options.size))
         if options.short:
             print(short_url(photo_id))
+    elif options.batch:
+        # Keep the output to one line per checksum:
+        show_progress = False
+        lookup_checksums(options, flickr)
+    elif options.sync:
+        sync_checksums(options, flickr)
     else:
         add_checksum(options, flickr)
 
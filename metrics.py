@@ -0,0 +1,144 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Timings and counters shared by all the tools.  Time is accumulated
+# per phase ("hash", "download", "sqlite", "api.photos_search", ...)
+# and counters count things like bytes hashed and cache hits.  With
+# --metrics FILENAME the totals are written out periodically (and at
+# exit) as JSON or in the Prometheus text file format.
+
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.counters = Counter()
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(time=time.time(),
+                        elapsed_seconds=time.time() - self.start,
+                        timers=dict((name, dict(calls=self.calls[name], seconds=self.seconds[name]))
+                                    for name in self.seconds),
+                        counters=dict(self.counters))
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True, indent=2) + "\n"
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = ["# TYPE flickr_checksums_phase_seconds_total counter"]
+        for name, timer in sorted(snapshot['timers'].items()):
+            lines.append('flickr_checksums_phase_seconds_total{phase="%s"} %f' % (name, timer['seconds']))
+        lines.append("# TYPE flickr_checksums_phase_calls_total counter")
+        for name, timer in sorted(snapshot['timers'].items()):
+            lines.append('flickr_checksums_phase_calls_total{phase="%s"} %d' % (name, timer['calls']))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append("# TYPE flickr_checksums_%s_total counter" % name)
+            lines.append("flickr_checksums_%s_total %d" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    # Write the metrics to 'filename' (atomically, so that a collector
+    # never sees half a file) as "json" or "prometheus":
+    def write(self, filename, format='json'):
+        text = self.to_prometheus() if format == 'prometheus' else self.to_json()
+        temporary_filename = filename + '.tmp'
+        with open(temporary_filename, 'w') as f:
+            f.write(text)
+        os.replace(temporary_filename, filename)
+
+    # Write the metrics every 'interval' seconds from a background
+    # thread, and once more when the program exits:
+    def write_periodically(self, filename, format='json', interval=60):
+        def loop():
+            while not stop.wait(interval):
+                self.write(filename, format)
+
+        def finish():
+            stop.set()
+            self.write(filename, format)
+
+        stop = threading.Event()
+        threading.Thread(target=loop, daemon=True).start()
+        atexit.register(finish)
+
+
+metrics = Metrics()
+
+
+# Wraps an object so that the time spent in each of its methods is
+# added to the metrics, as 'name', or as 'name.METHOD' if
+# 'per_method' is set:
+#
+#   flickr = Timed(flickrapi.FlickrAPI(...), 'api', per_method=True)
+class Timed:
+    def __init__(self, wrapped, name, per_method=False):
+        self.wrapped = wrapped
+        self.name = name
+        self.per_method = per_method
+
+    def __getattr__(self, attribute):
+        value = getattr(self.wrapped, attribute)
+        if not callable(value):
+            return value
+        name = self.name + '.' + attribute if self.per_method else self.name
+
+        def timed(*args, **kwargs):
+            with metrics.timer(name):
+                return value(*args, **kwargs)
+        return timed
+
+
+# Add the options for writing metrics to an ArgumentParser:
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics', dest='metrics', metavar='FILENAME',
+                        help='write timings and counters to FILENAME while running')
+    parser.add_argument('--metrics-format', dest='metrics_format', default='json',
+                        choices=['json', 'prometheus'],
+                        help='write the metrics as JSON (the default) or in the '
+                             'Prometheus text file format')
+    parser.add_argument('--metrics-interval', dest='metrics_interval', type=float, default=60,
+                        metavar='SECONDS',
+                        help='how often to write the metrics (default: every 60 seconds)')
+
+
+def start_metrics(args):
+    if args.metrics:
+        metrics.write_periodically(args.metrics, args.metrics_format, args.metrics_interval)
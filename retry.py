@@ -0,0 +1,205 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Retrying calls to Flickr (the API and the farm servers) that fail in
+# a way that might not happen again: HTTP 5xx and 429, timeouts,
+# dropped connections and the API's "service unavailable" errors.
+# Between attempts we wait a random time of up to 1, 2, 4, ... seconds
+# ("full jitter"), so that parallel workers don't all come back at
+# once.  Other errors, such as "photo not found", are raised straight
+# away.  The retries are counted in the metrics as NAME_retries.
+#
+# AdaptiveLimit cuts down how many calls run at once when they start
+# failing or slowing down, and lets it grow back when they succeed.
+
+import re
+import sys
+import random
+import threading
+import time
+
+from metrics import metrics
+
+MAX_ATTEMPTS = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+# Flickr API error codes that mean "try again later": 0 (the API is
+# not currently available), 105 (service currently unavailable) and
+# 106 (write operation failed):
+transient_flickr_codes = (0, 105, 106)
+
+
+class HTTPStatusError(IOError):
+    def __init__(self, status, url):
+        IOError.__init__(self, "Got HTTP status {0} fetching {1}".format(status, url))
+        self.status = status
+
+
+def transient_status(status):
+    return status >= 500 or status == 429
+
+# Whether 'error' is worth trying again after:
+def is_transient(error):
+    if isinstance(error, HTTPStatusError):
+        return transient_status(error.status)
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        from flickrapi.exceptions import FlickrError
+        if isinstance(error, FlickrError):
+            # flickrapi reports HTTP errors as "Status code 503 received":
+            match = re.search(r'Status code (\d+)', str(error))
+            if match:
+                return transient_status(int(match.group(1)))
+            return error.code in transient_flickr_codes
+    except ImportError:
+        pass
+    try:
+        import requests
+        if isinstance(error, (requests.ConnectionError, requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError)):
+            return True
+    except ImportError:
+        pass
+    try:
+        import urllib3
+        if isinstance(error, urllib3.exceptions.HTTPError):
+            return True
+    except ImportError:
+        pass
+    return False
+
+
+# How long to wait before attempt number 'attempt' + 1:
+def backoff(attempt):
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+# Return call(), trying up to 'attempts' times while it fails with
+# transient errors.  'before_retry' is called before each retry (to
+# take a token from the rate limiter, say), and with 'limit' (an
+# AdaptiveLimit) each attempt waits for a slot in it.  Only use this
+# for calls that are safe to repeat.
+def call_with_retries(name, call, attempts=MAX_ATTEMPTS, before_retry=None, limit=None):
+    attempt = 0
+    while True:
+        try:
+            if limit is None:
+                return call()
+            with limit:
+                return call()
+        except Exception as e:
+            attempt += 1
+            if not is_transient(e):
+                raise
+            if attempt >= attempts:
+                metrics.count(name + '_failures')
+                raise
+            delay = backoff(attempt - 1)
+            metrics.count(name + '_retries')
+            print("{0} failed ({1}); trying again in {2:.1f} s (attempt {3} of {4})".format(
+                name, e, delay, attempt + 1, attempts), file=sys.stderr)
+            with metrics.timer(name + '_backoff'):
+                time.sleep(delay)
+            if before_retry is not None:
+                before_retry()
+
+
+# Wraps an object so that the methods for which idempotent(name) is
+# true are retried with call_with_retries():
+#
+#   flickr = Retried(flickrapi.FlickrAPI(...), 'api', idempotent)
+class Retried:
+    def __init__(self, wrapped, name, idempotent, before_retry=None):
+        self.wrapped = wrapped
+        self.name = name
+        self.idempotent = idempotent
+        self.before_retry = before_retry
+
+    def __getattr__(self, attribute):
+        value = getattr(self.wrapped, attribute)
+        if not callable(value) or not self.idempotent(attribute):
+            return value
+
+        def retried(*args, **kwargs):
+            return call_with_retries(self.name, lambda: value(*args, **kwargs),
+                                     before_retry=self.before_retry)
+        return retried
+
+
+# Limits how many calls run at once, adjusting the limit like TCP does
+# its window: it grows by one after about 'limit' calls have
+# succeeded, and halves (at most once a second) when one fails with a
+# transient error or the calls get much slower than they have been.
+#
+#   limit = AdaptiveLimit(8)
+#   with limit:
+#       ...
+class AdaptiveLimit:
+    # Slow down once calls take this many times as long as the best
+    # (smoothed) time seen:
+    SLOWDOWN = 4.0
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.active = 0
+        self.condition = threading.Condition()
+        self.local = threading.local()
+        self.latency = None
+        self.best_latency = None
+        self.last_decrease = 0
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+        self.local.start = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        elapsed = time.time() - self.local.start
+        with self.condition:
+            self.active -= 1
+            if exception is not None:
+                if is_transient(exception):
+                    self.decrease()
+            elif self.slower(elapsed):
+                self.decrease()
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+        return False
+
+    # Add a call that took 'elapsed' seconds to the smoothed latency,
+    # and return whether that's now much worse than it has been:
+    def slower(self, elapsed):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * elapsed
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+        return self.latency > self.SLOWDOWN * max(self.best_latency, 0.01)
+
+    def decrease(self):
+        now = time.time()
+        if now - self.last_decrease < 1.0:
+            return
+        self.last_decrease = now
+        if self.limit > self.minimum:
+            self.limit = max(self.minimum, self.limit / 2)
+            metrics.count('concurrency_decreases')
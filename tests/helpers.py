@@ -0,0 +1,85 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# What the tests have in common: temporary files and databases, and a
+# fake clock.  Run the tests with:
+#
+#   python -m unittest discover tests
+
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+
+from flickr_checksum_tags import SqliteDb
+
+
+# Made-up checksums of photo number 'n':
+def md5(n):
+    return hashlib.md5(str(n).encode()).hexdigest()
+
+def sha1(n):
+    return hashlib.sha1(str(n).encode()).hexdigest()
+
+
+# Stands in for the time module: sleeping moves the clock on.
+class Clock:
+    def __init__(self):
+        self.now = 1000000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def write(self, name, data):
+        filename = self.path(name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+
+# With a fresh database in self.db:
+class DatabaseTestCase(TemporaryDirectoryTestCase):
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.db = SqliteDb(self.path('checksums.db'))
+
+    def tearDown(self):
+        self.db.connection.close()
+        TemporaryDirectoryTestCase.tearDown(self)
+
+    def add_photos(self, numbers, owner=None):
+        self.db.add_many_to_done((str(n), md5(n), sha1(n), None, None) for n in numbers)
+        if owner is not None:
+            for n in numbers:
+                self.db.set_owner(str(n), owner)
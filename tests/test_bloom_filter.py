@@ -0,0 +1,86 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of the Bloom filter in digest_index.py, and of the way
+# find_not_uploaded.py and flickr-upload.py use it.
+
+import hashlib
+import unittest
+from unittest import mock
+
+from helpers import DatabaseTestCase, md5, sha1
+
+from digest_index import BloomFilter, md5_bloom_filter
+from find_not_uploaded import is_not_uploaded
+
+
+# A Flickr that mustn't be asked:
+class NoFlickr:
+    def __getattr__(self, name):
+        raise AssertionError("Flickr was asked for " + name)
+
+
+class BloomFilterTest(DatabaseTestCase):
+    def test_no_false_negatives(self):
+        self.add_photos(range(1000))
+        bloom = BloomFilter.from_db(self.db, 'md5')
+        for n in range(1000):
+            self.assertIn(md5(n), bloom)
+        false_positives = sum(md5(n) in bloom for n in range(1000, 11000))
+        self.assertLess(false_positives, 300)
+
+    def test_save_and_load(self):
+        self.add_photos(range(1000))
+        filename = self.path('md5.bloom')
+        bloom = md5_bloom_filter(self.db, filename)
+        loaded = BloomFilter.load(filename)
+        self.assertEqual((loaded.n_bits, loaded.n_hashes), (bloom.n_bits, bloom.n_hashes))
+        self.assertEqual(loaded.fingerprint, self.db.fingerprint())
+        for n in range(1000, 3000):
+            self.assertEqual(md5(n) in loaded, md5(n) in bloom)
+        for n in range(1000):
+            self.assertIn(md5(n), loaded)
+
+    def test_rebuilt_when_the_database_changes(self):
+        self.add_photos(range(10))
+        filename = self.path('md5.bloom')
+        md5_bloom_filter(self.db, filename)
+        self.add_photos([10])
+        self.assertIn(md5(10), md5_bloom_filter(self.db, filename))
+
+    def test_added_digests_are_kept(self):
+        self.add_photos(range(10))
+        filename = self.path('md5.bloom')
+        bloom = md5_bloom_filter(self.db, filename)
+        # As flickr-upload.py records an upload:
+        self.db.add_to_done('10', md5(10), sha1(10))
+        bloom.add_and_save(md5(10), self.db, filename)
+        self.assertIn(md5(10), bloom)
+        bloom = md5_bloom_filter(self.db, filename)
+        self.assertIn(md5(10), bloom)
+        # Loaded from the file, rather than built again:
+        self.assertNotEqual(bloom.offset, 0)
+
+    def test_misses_are_trusted(self):
+        self.add_photos(range(10))
+        bloom = md5_bloom_filter(self.db, self.path('md5.bloom'))
+        data = b'a new photo'
+        filename = self.write('new.jpg', data)
+        self.assertNotIn(hashlib.md5(data).hexdigest(), bloom)
+        # Without asking the database either:
+        with mock.patch.object(self.db, 'find', side_effect=AssertionError("database was asked")):
+            self.assertTrue(is_not_uploaded(filename, self.db, NoFlickr(), bloom=bloom))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of hashing files in parallel with
+# find_not_uploaded.checksums_in_parallel().
+
+import hashlib
+import unittest
+
+from helpers import DatabaseTestCase
+
+from find_not_uploaded import checksums_in_parallel
+
+
+class ChecksumsInParallelTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.contents = {}
+        for n in range(40):
+            # Different sizes, so that they take different times:
+            data = str(n).encode() * (1000 * (40 - n))
+            self.contents[self.write('{0:02d}.jpg'.format(n), data)] = data
+        self.paths = sorted(self.contents)
+
+    def check(self, results, skipped=()):
+        for filename, checksums in results:
+            if filename in skipped:
+                self.assertIsNone(checksums)
+            else:
+                self.assertEqual(checksums['md5'], hashlib.md5(self.contents[filename]).hexdigest())
+    def test_ordered(self):
+        for jobs in (1, 3, 8):
+            with self.subTest(jobs=jobs):
+                results = list(checksums_in_parallel(self.paths, self.db, jobs))
+                self.assertEqual([filename for filename, _ in results], self.paths)
+                self.check(results)
+
+    def test_unordered(self):
+        results = list(checksums_in_parallel(self.paths, self.db, 4, unordered=True))
+        self.assertEqual(sorted(filename for filename, _ in results), self.paths)
+        self.check(results)
+
+    def test_skip(self):
+        skipped = set(self.paths[::3])
+        for unordered in (False, True):
+            with self.subTest(unordered=unordered):
+                results = list(checksums_in_parallel(self.paths, self.db, 4, unordered=unordered,
+                                                     skip=lambda filename: filename in skipped))
+                if not unordered:
+                    self.assertEqual([filename for filename, _ in results], self.paths)
+                self.assertEqual(sorted(filename for filename, _ in results), self.paths)
+                self.check(results, skipped)
+                for filename in skipped:
+                    self.assertIsNone(self.db.cached_file_checksums(filename))
+
+    def test_cached_results_keep_their_place(self):
+        # Cache every other file, so that cached and hashed files mix:
+        for filename, _ in checksums_in_parallel(self.paths[::2], self.db, 4):
+            self.assertIsNotNone(self.db.cached_file_checksums(filename))
+        results = list(checksums_in_parallel(self.paths, self.db, 4))
+        self.assertEqual([filename for filename, _ in results], self.paths)
+        self.check(results)
+
+
+if __name__ == '__main__':
+    unittest.main()
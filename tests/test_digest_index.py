@@ -0,0 +1,82 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of the md5 index in digest_index.py, and of keeping it in a
+# file between runs.
+
+import unittest
+
+from helpers import DatabaseTestCase, md5
+
+from digest_index import DigestIndex, md5_index
+
+
+class DigestIndexTest(DatabaseTestCase):
+    def test_contains(self):
+        self.add_photos(range(100))
+        index = DigestIndex.from_db(self.db, 'md5')
+        self.assertEqual(len(index), 100)
+        for n in range(100):
+            self.assertIn(md5(n), index)
+        for n in range(100, 200):
+            self.assertNotIn(md5(n), index)
+        self.assertNotIn('not a digest', index)
+
+    def test_from_hex_matches_from_db(self):
+        self.add_photos(range(50))
+        self.assertEqual(DigestIndex.from_db(self.db, 'md5').data,
+                         DigestIndex.from_hex([md5(n) for n in range(50)]).data)
+
+    def test_index_file_is_reused_until_the_database_changes(self):
+        self.add_photos(range(100))
+        filename = self.path('md5.index')
+        md5_index(self.db, filename)
+        index = md5_index(self.db, filename)
+        # Memory-mapped from the file rather than built again:
+        self.assertEqual(index.offset, DigestIndex.load(filename).offset)
+        self.assertNotEqual(index.offset, 0)
+        self.assertIn(md5(99), index)
+
+        self.add_photos([100])
+        index = md5_index(self.db, filename)
+        self.assertIn(md5(100), index)
+        self.assertIn(md5(100), DigestIndex.load(filename))
+
+    def test_index_file_is_rebuilt_when_a_checksum_is_filled_in(self):
+        # As --sync does for a photo it had found without an md5:
+        self.db.upsert_many_to_done([('1', None, None)])
+        filename = self.path('md5.index')
+        self.assertNotIn(md5(1), md5_index(self.db, filename))
+        self.db.upsert_many_to_done([('1', md5(1), None)])
+        self.assertIn(md5(1), md5_index(self.db, filename))
+
+    def test_other_writes_leave_the_fingerprint_alone(self):
+        self.add_photos(range(10))
+        fingerprint = self.db.fingerprint()
+        self.db.set_size('1', 1000, md5(1000))
+        self.db.set_owner('1', '12345678@N00')
+        self.db.set_state('sync_watermark', '0')
+        self.assertEqual(self.db.fingerprint(), fingerprint)
+        self.db.remove_photo('1')
+        self.assertNotEqual(self.db.fingerprint(), fingerprint)
+
+    def test_load_rejects_other_files(self):
+        filename = self.path('other')
+        with open(filename, 'wb') as f:
+            f.write(b'not an index at all, but long enough to have a header')
+        self.assertIsNone(DigestIndex.load(filename))
+        self.assertIsNone(DigestIndex.load(self.path('missing')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of finding photos that share a checksum in the local database,
+# for flickr_checksum_tags.py --duplicates.
+
+import argparse
+import contextlib
+import io
+import json
+import unittest
+from unittest import mock
+
+from helpers import DatabaseTestCase, md5, sha1
+
+import flickr_checksum_tags
+from flickr_checksum_tags import report_duplicates
+
+
+class DuplicatesTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.add_photos(range(200))
+        self.db.add_many_to_done([
+            # Copies of photo 5, which come out in order of photo id:
+            ('1000', md5(5), sha1(5), None, None),
+            ('40', md5(5), sha1(5), None, None),
+            # The same md5 as photo 99, but not the same sha1:
+            ('100000', md5(99), sha1(100000), None, None),
+            # Photos with no checksums aren't copies of each other:
+            ('2000', None, None, None, None),
+            ('2001', None, None, None, None),
+        ])
+        self.db.commit()
+        self.md5_groups = sorted([(md5(5), ['5', '40', '1000']), (md5(99), ['99', '100000'])])
+
+    def test_md5(self):
+        self.assertEqual(list(self.db.duplicates('md5')), self.md5_groups)
+
+    def test_sha1(self):
+        self.assertEqual(list(self.db.duplicates('sha1')), [(sha1(5), ['5', '40', '1000'])])
+
+    def test_unknown_column(self):
+        with self.assertRaises(ValueError):
+            list(self.db.duplicates('photo_id'))
+
+    def report(self, format):
+        options = argparse.Namespace(duplicates='md5', duplicates_format=format)
+        output, errors = io.StringIO(), io.StringIO()
+        with mock.patch.object(flickr_checksum_tags, 'checksum_db_filename', self.path('checksums.db')), \
+             contextlib.redirect_stdout(output), contextlib.redirect_stderr(errors):
+            report_duplicates(options)
+        self.assertEqual(errors.getvalue(), "2 photos have duplicates (3 extra copies)\n")
+        return output.getvalue()
+
+    def test_report(self):
+        groups = json.loads(self.report('json'))
+        self.assertEqual([(group['md5'], [photo['id'] for photo in group['photos']])
+                          for group in groups], self.md5_groups)
+        rows = self.report('csv').splitlines()
+        self.assertEqual(rows[0], 'md5,photo_id,short_url,copies')
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(len(self.report('text').splitlines()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of the partial checksum of the start and end of a file, and of
+# find_not_uploaded.py --quick ruling files out with it.
+
+import hashlib
+import random
+import unittest
+
+from helpers import TemporaryDirectoryTestCase, DatabaseTestCase
+
+from common import (PartialChecksum, chunks_checksums, file_checksums, partial_checksum,
+                    partial_checksum_span)
+from find_not_uploaded import ruled_out
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class PartialChecksumTest(TemporaryDirectoryTestCase):
+    span = partial_checksum_span
+    sizes = [0, 1, span - 1, span, span + 1, 2 * span - 1, 2 * span, 2 * span + 1,
+             3 * span + 12345, 10 * span]
+
+    def test_streamed_matches_partial_checksum(self):
+        generator = random.Random(0)
+        for size in self.sizes:
+            data = bytes(generator.getrandbits(8) for _ in range(size))
+            filename = self.write('photo.jpg', data)
+            for chunk_size in (1000, self.span, self.span + 1, 3 * self.span):
+                with self.subTest(size=size, chunk_size=chunk_size):
+                    checksums = chunks_checksums(chunked(data, chunk_size), ('md5', 'partial'))
+                    self.assertEqual(checksums['partial'], partial_checksum(filename))
+                    self.assertEqual(checksums['size'], size)
+                    self.assertEqual(checksums['md5'], hashlib.md5(data).hexdigest())
+
+    def test_covers_start_and_end(self):
+        data = bytes(4 * self.span)
+        partial = PartialChecksum()
+        partial.update(data)
+        self.assertEqual(partial.hexdigest(), hashlib.md5(bytes(2 * self.span)).hexdigest())
+
+        middle_changed = data[:2 * self.span] + b'x' + data[2 * self.span + 1:]
+        end_changed = data[:-1] + b'x'
+        self.assertEqual(partial_checksum(self.write('a', middle_changed)),
+                         partial_checksum(self.write('b', data)))
+        self.assertNotEqual(partial_checksum(self.write('c', end_changed)),
+                            partial_checksum(self.write('d', data)))
+
+    def test_file_checksums(self):
+        data = b'photo' * 100000
+        checksums = file_checksums(self.write('photo.jpg', data))
+        self.assertEqual(checksums, dict(md5=hashlib.md5(data).hexdigest(),
+                                         sha1=hashlib.sha1(data).hexdigest()))
+
+
+class RuledOutTest(DatabaseTestCase):
+    def test_only_files_unlike_any_photo_are_ruled_out(self):
+        data = bytes(range(256)) * 1000
+        uploaded = self.write('uploaded.jpg', data)
+        self.db.add_to_done('1', hashlib.md5(data).hexdigest(), hashlib.sha1(data).hexdigest(),
+                            len(data), partial_checksum(uploaded))
+        self.assertFalse(ruled_out(self.write('copy.jpg', data), self.db))
+        # The same size, but a different end:
+        self.assertTrue(ruled_out(self.write('edited.jpg', data[:-1] + b'x'), self.db))
+        self.assertTrue(ruled_out(self.write('longer.jpg', data + b'x'), self.db))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of retrying calls that fail transiently, and of limiting how
+# many run at once (retry.py), with a fake clock so that nothing
+# really sleeps.
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+from helpers import Clock
+
+from flickrapi.exceptions import FlickrError
+
+import retry
+from retry import HTTPStatusError, AdaptiveLimit, Retried, call_with_retries, is_transient
+
+
+# A call that fails with each of 'errors' in turn, then returns 'ok':
+class Failing:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        for patcher in (mock.patch.object(retry, 'time', self.clock),
+                        mock.patch('sys.stderr')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class IsTransientTest(unittest.TestCase):
+    def test_errors(self):
+        for error in (HTTPStatusError(503, 'url'), HTTPStatusError(429, 'url'),
+                      ConnectionResetError(), TimeoutError(),
+                      FlickrError("Error: 105: Service currently unavailable", code=105),
+                      FlickrError("Status code 502 received")):
+            self.assertTrue(is_transient(error), error)
+        for error in (HTTPStatusError(404, 'url'), ValueError(),
+                      FlickrError("Error: 1: Photo not found", code=1),
+                      FlickrError("Status code 403 received")):
+            self.assertFalse(is_transient(error), error)
+
+
+class CallWithRetriesTest(ClockTestCase):
+    def test_transient_errors_are_retried(self):
+        call = Failing(HTTPStatusError(503, 'url'), ConnectionResetError())
+        before_retry = mock.Mock()
+        self.assertEqual(call_with_retries('test', call, before_retry=before_retry), 'ok')
+        self.assertEqual(call.calls, 3)
+        self.assertEqual(before_retry.call_count, 2)
+        # Waiting up to 1 and then up to 2 seconds:
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertLessEqual(self.clock.sleeps[0], 1)
+        self.assertLessEqual(self.clock.sleeps[1], 2)
+
+    def test_other_errors_are_not(self):
+        call = Failing(HTTPStatusError(404, 'url'))
+        with self.assertRaises(HTTPStatusError):
+            call_with_retries('test', call)
+        self.assertEqual(call.calls, 1)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_gives_up(self):
+        call = Failing(*[HTTPStatusError(500 + n, 'url') for n in range(10)])
+        with self.assertRaises(HTTPStatusError) as raised:
+            call_with_retries('test', call, attempts=4)
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(call.calls, 4)
+        self.assertEqual(len(self.clock.sleeps), 3)
+
+    def test_retried(self):
+        class Api:
+            version = 2
+
+            def __init__(self):
+                self.photos_search = Failing(HTTPStatusError(503, 'url'))
+                self.upload = Failing(HTTPStatusError(503, 'url'))
+
+        api = Api()
+        retried = Retried(api, 'api', lambda name: name.startswith('photos_'))
+        self.assertEqual(retried.photos_search(), 'ok')
+        with self.assertRaises(HTTPStatusError):
+            retried.upload()
+        self.assertEqual(retried.version, 2)
+
+
+class AdaptiveLimitTest(ClockTestCase):
+    def fail(self, limit, error):
+        try:
+            with limit:
+                raise error
+        except type(error):
+            pass
+
+    def test_halves_on_transient_errors_at_most_once_a_second(self):
+        limit = AdaptiveLimit(8)
+        self.fail(limit, HTTPStatusError(503, 'url'))
+        self.assertEqual(int(limit.limit), 4)
+        self.fail(limit, HTTPStatusError(503, 'url'))
+        self.assertEqual(int(limit.limit), 4)
+        self.clock.now += 1
+        self.fail(limit, HTTPStatusError(503, 'url'))
+        self.assertEqual(int(limit.limit), 2)
+        # Other errors don't count:
+        self.clock.now += 1
+        self.fail(limit, HTTPStatusError(404, 'url'))
+        self.assertEqual(int(limit.limit), 2)
+
+    def test_never_below_the_minimum(self):
+        limit = AdaptiveLimit(8, minimum=3)
+        for _ in range(5):
+            self.clock.now += 1
+            self.fail(limit, TimeoutError())
+        self.assertEqual(limit.limit, 3)
+
+    def test_grows_back(self):
+        limit = AdaptiveLimit(8)
+        self.fail(limit, TimeoutError())
+        for _ in range(100):
+            with limit:
+                pass
+        self.assertEqual(limit.limit, 8)
+
+    def test_slows_down_when_calls_get_slower(self):
+        limit = AdaptiveLimit(8)
+        for seconds in [0.1] * 10 + [2.0] * 3:
+            with limit:
+                self.clock.now += seconds
+        self.assertLess(limit.limit, 8)
+
+
+class AdaptiveLimitThreadsTest(unittest.TestCase):
+    def test_no_more_than_the_limit_run_at_once(self):
+        limit = AdaptiveLimit(3)
+        lock = threading.Lock()
+        running = [0]
+        most = [0]
+
+        def call():
+            with limit:
+                with lock:
+                    running[0] += 1
+                    most[0] = max(most[0], running[0])
+                time.sleep(0.01)
+                with lock:
+                    running[0] -= 1
+        threads = [threading.Thread(target=call) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(most[0], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of finding the files to look at with common.scan_files() and
+# the options add_scan_arguments() adds for it.
+
+import argparse
+import os
+import unittest
+
+from helpers import TemporaryDirectoryTestCase
+
+from common import scan_files, expand_paths, add_scan_arguments
+
+
+class ScanFilesTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        for name, size in [('a.jpg', 100), ('b.JPG', 100), ('c.png', 100), ('small.jpg', 10),
+                           ('a.jpg.xmp', 10), ('README', 10),
+                           ('2020/d.jpg', 100), ('2020/e.nef', 100), ('2020/raw/f.nef', 100),
+                           ('.hidden/g.jpg', 100)]:
+            self.write(name, b'x' * size)
+
+    def scan(self, patterns=None, **filters):
+        if patterns is None:
+            patterns = [self.directory.name]
+        paths = scan_files(patterns, **filters)
+        return sorted(os.path.relpath(path, self.directory.name) for path in paths)
+
+    def test_directories_are_walked(self):
+        self.assertEqual(self.scan(), ['.hidden/g.jpg', '2020/d.jpg', '2020/e.nef',
+                                       '2020/raw/f.nef', 'a.jpg', 'b.JPG', 'c.png', 'small.jpg'])
+
+    def test_globs(self):
+        self.assertEqual(self.scan([self.path('*.jpg')]), ['a.jpg', 'small.jpg'])
+        self.assertEqual(self.scan([self.path('2020/*')]), ['2020/d.jpg', '2020/e.nef'])
+
+    def test_extensions(self):
+        self.assertEqual(self.scan(include_extensions=['jpg']),
+                         ['.hidden/g.jpg', '2020/d.jpg', 'a.jpg', 'b.JPG', 'small.jpg'])
+        self.assertEqual(self.scan(include_extensions=['.NEF']), ['2020/e.nef', '2020/raw/f.nef'])
+        self.assertEqual(self.scan(exclude_extensions=['jpg', 'nef']),
+                         ['a.jpg.xmp', 'c.png'])
+
+    def test_include_and_exclude_globs(self):
+        self.assertEqual(self.scan(include_globs=['*/2020/*']),
+                         ['2020/d.jpg', '2020/e.nef', '2020/raw/f.nef'])
+        self.assertEqual(self.scan(include_globs=['[ab].*'], exclude_globs=['*.JPG']), ['a.jpg'])
+        self.assertEqual(self.scan(exclude_globs=['*/raw/*', '*.jpg']), ['2020/e.nef', 'b.JPG', 'c.png'])
+
+    def test_size_and_hidden_directories(self):
+        self.assertNotIn('small.jpg', self.scan(min_size=50))
+        self.assertEqual(len(self.scan(min_size=50)), 7)
+        self.assertEqual(self.scan(skip_hidden=True, include_extensions=['jpg']),
+                         ['2020/d.jpg', 'a.jpg', 'b.JPG', 'small.jpg'])
+
+    def test_hardlinks_are_only_yielded_once(self):
+        os.link(self.path('a.jpg'), self.path('2020/a-link.jpg'))
+        os.link(self.path('a.jpg'), self.path('2020/raw/a-link.jpg'))
+        paths = self.scan(include_globs=['a*.jpg'])
+        self.assertEqual(len(paths), 1)
+        self.assertIn(paths[0], ['a.jpg', '2020/a-link.jpg', '2020/raw/a-link.jpg'])
+        self.assertEqual(len(self.scan(include_globs=['a*.jpg'], dedupe_hardlinks=False)), 3)
+        # Even when the same file is given twice:
+        self.assertEqual(self.scan([self.path('a.jpg'), self.path('a.jpg')]), ['a.jpg'])
+
+    def test_command_line_options(self):
+        parser = argparse.ArgumentParser()
+        add_scan_arguments(parser)
+        args = parser.parse_args(['--include-ext', 'jpg', '--exclude', '*/.hidden/*',
+                                  '--min-size', '50'])
+        paths = expand_paths([self.directory.name], args)
+        self.assertEqual(sorted(os.path.relpath(path, self.directory.name) for path in paths),
+                         ['2020/d.jpg', 'a.jpg', 'b.JPG'])
+        # Sidecar files are left out unless asked for:
+        args = parser.parse_args([])
+        self.assertNotIn(self.path('a.jpg.xmp'), list(expand_paths([self.directory.name], args)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of checksum snapshots (digest_index.Snapshot), and of
+# find_not_uploaded.py --snapshot.
+
+import contextlib
+import hashlib
+import io
+import os
+import unittest
+
+from helpers import DatabaseTestCase, md5, sha1
+
+from digest_index import Snapshot, md5_index
+from find_not_uploaded import is_not_uploaded
+from flickr_checksum_tags import SqliteDb
+
+
+class SnapshotTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.add_photos(range(200))
+        # Two photos of the same file, and one without a sha1:
+        self.db.add_many_to_done([('1000', md5(5), sha1(5), None, None),
+                                  ('1001', md5(1001), None, None, None)])
+        self.filename = self.path('checksums.snapshot')
+        self.n_written = Snapshot.write(self.db, self.filename)
+
+    def test_round_trip(self):
+        snapshot = Snapshot.load(self.filename)
+        self.assertEqual(self.n_written, 202)
+        self.assertEqual(len(snapshot), 202)
+        records = list(snapshot.records())
+        expected = [(str(n), md5(n), sha1(n)) for n in range(200)]
+        expected += [('1000', md5(5), sha1(5)), ('1001', md5(1001), None)]
+        self.assertEqual(sorted(records), sorted(expected))
+        # In order of md5:
+        self.assertEqual([r[1] for r in records], sorted(r[1] for r in records))
+
+    def test_find(self):
+        snapshot = Snapshot.load(self.filename)
+        self.assertEqual(snapshot.find(md5=md5(7)), ['7'])
+        self.assertEqual(sorted(snapshot.find(md5=md5(5))), ['1000', '5'])
+        self.assertEqual(sorted(snapshot.find(sha1=sha1(5))), ['1000', '5'])
+        self.assertEqual(snapshot.find(md5=md5(1001)), ['1001'])
+        self.assertEqual(snapshot.find(md5=md5(5000)), [])
+        self.assertEqual(snapshot.find(sha1=sha1(5000)), [])
+        self.assertIn(md5(199), snapshot)
+        self.assertNotIn(md5(200), snapshot)
+
+    def test_import_into_another_database(self):
+        other = SqliteDb(self.path('other.db'))
+        other.upsert_many_to_done(Snapshot.load(self.filename).records())
+        self.assertEqual(other.find(photo_id='1001')[0]['sha1'], None)
+        self.assertEqual(other.find(photo_id='7')[0]['md5'], md5(7))
+        self.assertEqual(other.fingerprint()[0], 202)
+        other.connection.close()
+
+    def test_damage_is_detected(self):
+        with open(self.filename, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xff]))
+        with self.assertRaises(ValueError):
+            Snapshot.load(self.filename)
+        self.assertEqual(len(Snapshot.load(self.filename, verify=False)), 202)
+
+    def test_other_files_are_rejected(self):
+        with open(self.filename, 'r+b') as f:
+            f.truncate(100)
+        with self.assertRaises(ValueError):
+            Snapshot.load(self.filename)
+
+    def test_found_whether_or_not_verbose(self):
+        contents = [b'in the snapshot', b'in the database', b'in neither']
+        other = SqliteDb(self.path('other.db'))
+        other.add_to_done('3000', hashlib.md5(contents[0]).hexdigest(), None)
+        other.commit()
+        Snapshot.write(other, self.path('other.snapshot'))
+        other.connection.close()
+        snapshot = Snapshot.load(self.path('other.snapshot'))
+        self.db.add_to_done('3001', hashlib.md5(contents[1]).hexdigest(), None)
+        filenames = [self.write('{0}.jpg'.format(n), data) for n, data in enumerate(contents)]
+        for index in (None, md5_index(self.db)):
+            for verbose in (False, True):
+                with self.subTest(index=index is not None, verbose=verbose):
+                    output = io.StringIO()
+                    with contextlib.redirect_stdout(output):
+                        results = [is_not_uploaded(filename, self.db, None, verbose, index=index,
+                                                   snapshot=snapshot)
+                                   for filename in filenames]
+                    self.assertEqual(results, [False, False, True])
+                    if verbose:
+                        self.assertIn("  3000\n", output.getvalue())
+                        self.assertIn("  3001\n", output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of writing to and reading from the local database (SqliteDb).
+
+import unittest
+
+from helpers import DatabaseTestCase, md5, sha1
+
+
+class SqliteDbTest(DatabaseTestCase):
+    def test_adding_fills_in_photos_already_there(self):
+        # As --sync records a photo tagged with only an md5, and one
+        # with nothing:
+        self.db.upsert_many_to_done([('1', md5(1), None), ('2', None, None)])
+        self.db.set_size('1', 1000, md5(1000))
+        # ... and -a then tags them:
+        self.db.add_many_to_done([('1', md5(1), sha1(1), None, None),
+                                  ('2', md5(2), sha1(2), 2000, md5(2000))])
+        self.assertEqual(self.db.find(photo_id='1'),
+                         [dict(photo_id='1', md5=md5(1), sha1=sha1(1), size=1000,
+                               partial_md5=md5(1000))])
+        self.assertEqual(self.db.find(photo_id='2'),
+                         [dict(photo_id='2', md5=md5(2), sha1=sha1(2), size=2000,
+                               partial_md5=md5(2000))])
+
+    def test_find_by_owner(self):
+        self.add_photos(range(3), owner='12345678@N00')
+        self.add_photos(range(3, 6), owner='other@N01')
+        self.add_photos(range(6, 9))
+        for n in range(9):
+            found = self.db.find(md5=md5(n), owner='12345678@N00')
+            self.assertEqual([row['photo_id'] for row in found], [str(n)] if n < 3 else [])
+            found = self.db.find(sha1=sha1(n), owner='12345678@N00')
+            self.assertEqual([row['photo_id'] for row in found], [str(n)] if n < 3 else [])
+            self.assertEqual(len(self.db.find(md5=md5(n))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of the parts of flickr_checksum_tags.py --sync that deal with
+# photos changing on Flickr while it runs, against a stand-in for the
+# Flickr API.
+
+import unittest
+from unittest import mock
+
+from helpers import DatabaseTestCase
+
+from flickrapi.exceptions import FlickrError
+from lxml import etree
+
+import flickr_checksum_tags
+from flickr_checksum_tags import recently_updated, remove_deleted_photos
+
+NSID = '12345678@N00'
+
+
+# Answers photos_recentlyUpdated from 'photos', a list of [photo_id,
+# lastupdate] with the most recently updated last.  'changes' maps the
+# number of a call to a function that changes the list before it's
+# answered.
+class RecentlyUpdated:
+    def __init__(self, n_photos, changes=None):
+        self.photos = [[str(n), '1'] for n in range(n_photos)]
+        self.changes = changes or {}
+        self.calls = 0
+
+    def photos_recentlyUpdated(self, per_page, page, min_date, extras):
+        self.calls += 1
+        if self.calls in self.changes:
+            self.changes[self.calls](self.photos)
+        per_page = int(per_page)
+        rsp = etree.Element('rsp')
+        photos = etree.SubElement(rsp, 'photos')
+        for photo_id, lastupdate in self.photos[(page - 1) * per_page:page * per_page]:
+            etree.SubElement(photos, 'photo', id=photo_id, lastupdate=lastupdate)
+        return rsp
+
+
+# Move photo 'photo_id' to the end, as if it had just been updated:
+def update(photo_id):
+    def change(photos):
+        for photo in photos:
+            if photo[0] == photo_id:
+                photos.remove(photo)
+                photos.append([photo_id, str(int(photo[1]) + 1)])
+                return
+    return change
+
+
+class RecentlyUpdatedTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(flickr_checksum_tags, 'show_progress', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_page_is_read_once(self):
+        flickr = RecentlyUpdated(20)
+        photos, complete = recently_updated(flickr, 0, '')
+        self.assertEqual(sorted(photos, key=int), [str(n) for n in range(20)])
+        self.assertTrue(complete)
+        self.assertEqual(flickr.calls, 1)
+
+    def test_pages_are_read_until_they_stop_changing(self):
+        flickr = RecentlyUpdated(1200)
+        photos, complete = recently_updated(flickr, 0, '')
+        self.assertEqual(len(photos), 1200)
+        self.assertTrue(complete)
+        # Three pages, read twice:
+        self.assertEqual(flickr.calls, 6)
+
+    def test_photo_moved_to_a_page_already_read(self):
+        # Photo 5 is updated once the first page has been read, and
+        # moves to the end.  The photos after it all move back a
+        # place, so photo 500 moves onto the first page and a single
+        # reading would miss it:
+        flickr = RecentlyUpdated(1200, {2: update('5')})
+        photos, complete = recently_updated(flickr, 0, '')
+        self.assertEqual(len(photos), 1200)
+        self.assertIn('500', photos)
+        self.assertEqual(photos['5'].attrib['lastupdate'], '2')
+        self.assertTrue(complete)
+        self.assertEqual(flickr.calls, 9)
+
+    def test_gives_up_if_the_photos_keep_changing(self):
+        changes = dict((call, update(str(call))) for call in range(2, 20, 3))
+        flickr = RecentlyUpdated(1200, changes)
+        photos, complete = recently_updated(flickr, 0, '', max_readings=3)
+        self.assertFalse(complete)
+        self.assertEqual(flickr.calls, 9)
+        self.assertEqual(len(photos), 1200)
+
+
+# Answers photos_getInfo from 'owners', a dict of photo_id to the
+# owner's NSID; other photos aren't found.  Photos in 'failing' fail
+# with "service unavailable".
+class PhotoInfo:
+    def __init__(self, owners, failing=()):
+        self.owners = owners
+        self.failing = failing
+        self.looked_up = []
+
+    def photos_getInfo(self, photo_id):
+        self.looked_up.append(photo_id)
+        if photo_id in self.failing:
+            raise FlickrError("Error: 105: Service currently unavailable", code=105)
+        if photo_id not in self.owners:
+            raise FlickrError("Error: 1: Photo not found", code=1)
+        rsp = etree.Element('rsp')
+        photo = etree.SubElement(rsp, 'photo', id=photo_id)
+        etree.SubElement(photo, 'owner', nsid=self.owners[photo_id])
+        return rsp
+
+
+class RemoveDeletedPhotosTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        # Photos 0-9 are ours, 10-14 someone else's and 15-19 of no
+        # known owner:
+        self.add_photos(range(10), owner=NSID)
+        self.add_photos(range(10, 15), owner='other@N01')
+        self.add_photos(range(15, 20))
+
+    def remaining(self):
+        return sorted(int(n) for n in range(20) if self.db.find(photo_id=str(n)))
+
+    def test_only_photos_that_are_gone_are_removed(self):
+        seen = set(str(n) for n in range(5))
+        # 5 and 6 are gone and 7-9 were missed by the sync; 15 is
+        # ours, 16 someone else's and 17-19 are gone:
+        owners = dict((str(n), NSID) for n in (7, 8, 9, 15))
+        owners['16'] = 'other@N01'
+        flickr = PhotoInfo(owners)
+        removed = remove_deleted_photos(self.db, flickr, NSID, seen)
+        self.assertEqual(removed, 5)
+        self.assertEqual(self.remaining(), [0, 1, 2, 3, 4, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16])
+        # Photos seen, and other people's, aren't looked up:
+        self.assertEqual(sorted(flickr.looked_up, key=int),
+                         [str(n) for n in (5, 6, 7, 8, 9, 15, 16, 17, 18, 19)])
+        # The owners found are recorded, so 16 isn't looked up again:
+        flickr = PhotoInfo(owners)
+        self.assertEqual(remove_deleted_photos(self.db, flickr, NSID, seen), 0)
+        self.assertEqual(sorted(flickr.looked_up, key=int), ['7', '8', '9', '15'])
+
+    def test_other_errors_remove_nothing(self):
+        flickr = PhotoInfo({}, failing=('5',))
+        with self.assertRaises(FlickrError):
+            remove_deleted_photos(self.db, flickr, NSID, set(str(n) for n in range(5)))
+        self.assertIn(5, self.remaining())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of the token bucket that paces Flickr API calls, with a fake
+# clock so that nothing really sleeps.
+
+import threading
+import unittest
+from unittest import mock
+
+from helpers import TemporaryDirectoryTestCase, Clock
+
+import flickr_checksum_tags
+from flickr_checksum_tags import Throttler
+
+
+class ThrottlerTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.clock = Clock()
+        patcher = mock.patch.object(flickr_checksum_tags, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def shared(self):
+        throttler = Throttler()
+        throttler.share_state(self.path('rate-limit.db'))
+        self.addCleanup(throttler.connection.close)
+        return throttler
+
+    def test_burst_then_paced(self):
+        throttler = Throttler()
+        for _ in range(Throttler.BURST):
+            throttler.register()
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(throttler.remaining(), 0)
+        for _ in range(10):
+            throttler.register()
+        self.assertEqual(len(self.clock.sleeps), 10)
+        for seconds in self.clock.sleeps:
+            self.assertAlmostEqual(seconds, 1 / throttler.rate)
+        self.assertEqual(throttler.n_requests, Throttler.BURST + 10)
+
+    def test_refills_up_to_the_burst(self):
+        throttler = Throttler()
+        for _ in range(Throttler.BURST):
+            throttler.register()
+        self.clock.now += 10.5 / throttler.rate
+        self.assertEqual(throttler.remaining(), 10)
+        self.clock.now += 1000 / throttler.rate
+        self.assertEqual(throttler.remaining(), Throttler.BURST)
+
+    def test_processes_share_the_bucket(self):
+        first, second = self.shared(), self.shared()
+        for _ in range(Throttler.BURST - 5):
+            first.register()
+        self.assertEqual(second.remaining(), 5)
+        for _ in range(5):
+            second.register()
+        self.assertEqual(self.clock.sleeps, [])
+        first.register()
+        self.assertEqual(len(self.clock.sleeps), 1)
+        # A new process starts where the others left off:
+        self.assertEqual(self.shared().remaining(), 0)
+
+    def test_threads_take_one_token_each(self):
+        throttler = self.shared()
+        start = self.clock.now
+
+        def register():
+            for _ in range(20):
+                throttler.register()
+        threads = [threading.Thread(target=register) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(throttler.n_requests, 160)
+        # None lost, and none taken twice:
+        throttler.remaining()
+        refilled = (self.clock.now - start) * throttler.rate
+        self.assertAlmostEqual(throttler.tokens, Throttler.BURST - 160 + refilled, places=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
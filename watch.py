@@ -0,0 +1,221 @@
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Watch directories for new and changed files, for flickr-upload.py
+# --watch.  On Linux the kernel tells us about changes (inotify, used
+# through ctypes so that nothing needs installing); elsewhere, or if
+# inotify can't be used, the directories are rescanned every so often.
+# Either way a file is only handed out once its size and modification
+# time have stopped changing, so that half-copied files aren't
+# uploaded.
+
+import glob
+import os
+import select
+import struct
+import time
+
+from common import expand_paths
+
+
+class Inotify:
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    # wd, mask, cookie and length of the name that follows:
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.directories = {}
+
+    def add_watch(self, directory):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self.directories[wd] = directory
+
+    # Wait up to 'timeout' seconds (for ever if None) and return a list
+    # of (path, mask) for what happened.  A path of None means events
+    # were lost, and everything should be looked at again.
+    def read(self, timeout=None):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif mask & self.IN_IGNORED:
+                self.directories.pop(wd, None)
+            elif wd in self.directories and name:
+                events.append((os.path.join(self.directories[wd], os.fsdecode(name)), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Yields the files below 'directories' that are new, or have changed,
+# since it was started, once they have been left alone for 'settle'
+# seconds.  'args' are the options from common.add_scan_arguments(),
+# to filter the files with.  Without inotify the directories are
+# rescanned every 'interval' seconds.
+#
+#   watcher = Watcher(['Pictures'], args)
+#   existing = watcher.start()    # the files that are already there
+#   for path in watcher:
+#       ...
+class Watcher:
+    def __init__(self, directories, args=None, settle=5.0, interval=30.0):
+        self.directories = directories
+        self.args = args
+        self.settle = settle
+        self.interval = interval
+        self.inotify = None
+        # The (size, mtime_ns) of the files already handed out, and of
+        # the ones waiting to settle, with when they last changed:
+        self.known = {}
+        self.pending = {}
+
+    # Start watching, and return the files that are already there.  (A
+    # file that changes after it has been returned will be yielded
+    # again later.)
+    def start(self):
+        try:
+            self.inotify = Inotify()
+            for directory in self.directories:
+                self.watch_tree(directory)
+        except (OSError, AttributeError):
+            # Not Linux, or too many directories for the inotify limit:
+            if self.inotify is not None:
+                self.inotify.close()
+            self.inotify = None
+        existing = list(expand_paths(self.directories, self.args))
+        for path in existing:
+            stamp = self.stamp(path)
+            if stamp is not None:
+                self.known[path] = stamp
+        return existing
+
+    def method(self):
+        return 'inotify' if self.inotify is not None else 'polling'
+
+    def watch_tree(self, top):
+        skip_hidden = self.args is not None and self.args.skip_hidden
+        self.inotify.add_watch(top)
+        for directory, subdirectories, _ in os.walk(top):
+            if skip_hidden:
+                subdirectories[:] = [d for d in subdirectories if not d.startswith('.')]
+            for subdirectory in subdirectories:
+                self.inotify.add_watch(os.path.join(directory, subdirectory))
+
+    def stamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    # Note that 'path' may have changed:
+    def changed(self, path):
+        stamp = self.stamp(path)
+        if stamp is None or self.known.get(path) == stamp:
+            return
+        if path not in self.pending or self.pending[path][0] != stamp:
+            self.pending[path] = (stamp, time.time())
+
+    def rescan(self):
+        seen = set()
+        for path in expand_paths(self.directories, self.args):
+            seen.add(path)
+            self.changed(path)
+        # Forget files that have gone, so that the memory use doesn't grow:
+        self.known = dict((path, stamp) for path, stamp in self.known.items() if path in seen)
+
+    # The files that haven't changed for 'settle' seconds, and are
+    # among those that the scan options let through:
+    def settled(self):
+        now = time.time()
+        ready = []
+        for path, (stamp, since) in list(self.pending.items()):
+            current = self.stamp(path)
+            if current is None:
+                del self.pending[path]
+            elif current != stamp:
+                self.pending[path] = (current, now)
+            elif now - since >= self.settle:
+                del self.pending[path]
+                self.known[path] = stamp
+                if list(expand_paths([glob.escape(path)], self.args)):
+                    ready.append(path)
+        return ready
+
+    def __iter__(self):
+        last_scan = time.time()
+        while True:
+            if self.inotify is None:
+                timeout = 1.0 if self.pending else max(0.0, last_scan + self.interval - time.time())
+                time.sleep(timeout)
+                if time.time() - last_scan >= self.interval:
+                    self.rescan()
+                    last_scan = time.time()
+            else:
+                timeout = 1.0 if self.pending else None
+                for path, mask in self.inotify.read(timeout):
+                    if path is None:
+                        self.rescan()
+                    elif mask & Inotify.IN_ISDIR:
+                        if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                            self.watch_new_directory(path)
+                    else:
+                        self.changed(path)
+            for path in self.settled():
+                yield path
+
+    # A directory has been created or moved in: watch it, and look at
+    # whatever got into it before the watch was set up.
+    def watch_new_directory(self, directory):
+        if self.args is not None and self.args.skip_hidden and \
+                os.path.basename(directory).startswith('.'):
+            return
+        try:
+            self.watch_tree(directory)
+        except OSError:
+            pass
+        for path in expand_paths([directory], self.args):
+            self.changed(path)